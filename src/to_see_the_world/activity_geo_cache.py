@@ -0,0 +1,106 @@
+#!/usr/bin/env python3.11
+import hashlib
+import os
+from pathlib import Path
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+class ActivityGeoCache:
+    """
+    Geocoding results per activity, keyed by a hash of
+    the activity's polyline (or coords) and the point
+    sampling used. Each entry holds (country_code,
+    admin_name, border_crossings, runs), where runs is
+    the ((country_code, number of points), ...) runs of
+    the sampled points. Activities without any
+    resolved point have an empty (None) entry. The
+    whole store is dropped when the boundary or city
+    data changes.
+    """
+    version = 1
+
+    def __init__(self, fname='', dataset_version=''):
+        self.fname = fname
+        self.dataset_version = \
+            f'{self.version}:{dataset_version}'
+        self.entries = {}
+        self.dirty = False
+        if self.fname:
+            self.load()
+
+    def get_keys(self, df, sampling):
+        if 'map/summary_polyline' in df.columns:
+            sources = df['map/summary_polyline'].map(
+                lambda x: str(x).encode())
+        else:
+            sources = df.coords.map(lambda x: np.asarray(
+                x, dtype=np.float64).tobytes())
+        return sources.map(lambda x: hashlib.sha1(
+            x + sampling.encode()).hexdigest())
+
+    def lookup(self, ids, keys):
+        """
+        Returns a hit mask and a frame of id,
+        country_code, admin_name and border_crossings
+        for the hits. Empty hits have no row.
+        """
+        hit = np.array([k in self.entries for k in keys],
+            dtype=np.bool_)
+        rows = [(i,) + self.entries[k][:3] for i, k in
+            zip(np.asarray(ids)[hit],
+            np.asarray(keys)[hit])
+            if self.entries[k] is not None]
+        return hit, pd.DataFrame(rows, columns=[
+            'id', 'country_code', 'admin_name',
+            'border_crossings'])
+
+    def update(self, keys, df_summary, runs):
+        # keys: id -> key of the computed activities
+        for i, cc, admin_name, bc in zip(
+            df_summary.id, df_summary.country_code,
+            df_summary.admin_name,
+            df_summary.border_crossings):
+            self.entries[keys[i]] = (cc, admin_name, bc,
+                runs.get(i, ()))
+        self.dirty = self.dirty or len(df_summary) > 0
+
+    def update_empty(self, keys, ids):
+        # keys: id -> key, ids: activities computed
+        # without any resolved point
+        for i in ids:
+            self.entries[keys[i]] = None
+        self.dirty = self.dirty or len(ids) > 0
+
+    def get_stats(self, hits, total):
+        return (f'Activity geo cache: {hits} of {total} '
+            f'activities cached, {len(self.entries)} '
+            'entries')
+
+    def load(self):
+        try:
+            with open(self.fname, 'rb') as f:
+                data = pickle.load(f)
+        except (FileNotFoundError, EOFError,
+            pickle.UnpicklingError):
+            return
+        if data.get('version') != self.dataset_version:
+            print('Activity geo cache is out of date. '
+                'Starting a new one.')
+            return
+        self.entries = data['entries']
+
+    def save(self):
+        if not self.fname or not self.dirty:
+            return
+        Path(self.fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{self.fname}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': self.dataset_version,
+                'entries': self.entries}, f,
+                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.fname)
+        self.dirty = False
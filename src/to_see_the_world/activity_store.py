@@ -0,0 +1,293 @@
+#!/usr/bin/env python3.11
+import glob
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+class ActivityStore:
+    """
+    Activities partitioned by athlete and year of
+    start_date_local, one folder of .npy arrays per
+    partition (<folder>/<athlete id>/<year>/). Every
+    column is typed: int64, float64, strings as one
+    utf-8 blob with offsets, and coords as flat lat and
+    lon arrays with per-activity offsets. Missing
+    values are kept in a null mask and the pandas
+    dtype of every column is restored on load. Saving
+    rewrites
+    only the partitions of the rows given, each one
+    atomically. Loading reads only the partitions of
+    the athletes and years asked for, and only the
+    columns asked for.
+    """
+    version = 1
+    time_col = 'start_date_local'
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def get_athletes(self):
+        if not self.folder.exists():
+            return []
+        return sorted(int(p.name) for p in
+            self.folder.iterdir() if p.name.isdigit())
+
+    def has_athlete(self, a_id):
+        return (self.folder / str(a_id)).is_dir()
+
+    def get_partitions(self, a_ids=None,
+        s_time_str='', e_time_str='', years=None):
+        if a_ids is None:
+            a_ids = self.get_athletes()
+        s_year = s_time_str[:4] or '0000'
+        e_year = e_time_str[:4] or '9999'
+        parts = []
+        for a_id in a_ids:
+            for p in sorted(glob.glob(f'{self.folder}/'
+                f'{a_id}/[0-9][0-9][0-9][0-9]')):
+                year = Path(p).name
+                if s_year <= year <= e_year and (
+                    years is None or year in years):
+                    parts.append(Path(p))
+        return parts
+
+    def get_id_index(self, a_id):
+        """
+        Partition year of every stored activity of
+        the athlete, indexed by id. Only the id arrays
+        are read.
+        """
+        ids, years = [], []
+        for p in self.get_partitions([a_id]):
+            with open(p / 'meta.json') as f:
+                meta = json.load(f)
+            ids.append(self.read_column(p, 'id',
+                meta['columns']['id'], meta['rows']))
+            years += [p.name] * meta['rows']
+        if not ids:
+            return pd.Series([], dtype=object)
+        return pd.Series(years,
+            index=np.concatenate(ids))
+
+    def get_years(self, df):
+        # Partition year of every row
+        return df[self.time_col].fillna('').astype(
+            str).str[:4].where(lambda x: x.str.match(
+            r'^\d{4}$'), '0000')
+
+    def load(self, a_ids=None, s_time_str='',
+        e_time_str='', columns=None, years=None):
+        """
+        Activities of a_ids (all athletes when None)
+        with s_time_str <= start_date_local <=
+        e_time_str, the same string comparison as
+        Utils.limit_time. years limits the partitions
+        read and columns projects the frame.
+        """
+        frames = [self.load_partition(p, columns)
+            for p in self.get_partitions(
+            a_ids, s_time_str, e_time_str, years)]
+        frames = [f for f in frames if len(f)]
+        if not frames:
+            return pd.DataFrame(columns=columns or [])
+        df = pd.concat(frames, ignore_index=True)
+        keep = np.ones(len(df), dtype=np.bool_)
+        if s_time_str:
+            keep &= (df[self.time_col] >= s_time_str
+                ).to_numpy()
+        if e_time_str:
+            keep &= (df[self.time_col] <= e_time_str
+                ).to_numpy()
+        if not keep.all():
+            df = df[keep].reset_index(drop=True)
+        if columns is not None:
+            df = df[[c for c in columns
+                if c in df.columns]]
+        return df
+
+    def load_partition(self, path, columns=None):
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        if meta.get('version') != self.version:
+            raise ValueError(f'{path} was written by '
+                'another version of the activity store')
+        names = list(meta['columns'])
+        if columns is not None:
+            # The time column is needed for filtering
+            names = [c for c in names if c in columns
+                or c == self.time_col]
+        return pd.DataFrame({c: self.read_column(
+            path, c, meta['columns'][c], meta['rows'])
+            for c in names}, columns=names)
+
+    def save(self, df):
+        """
+        Replaces the partitions of every (athlete,
+        year) in df with the rows of df.
+        """
+        for (a_id, year), dfp in df.groupby(
+            [df['athlete/id'].astype(np.int64),
+            self.get_years(df)],
+            sort=False):
+            self.save_partition(int(a_id), year, dfp)
+
+    def remove_partition(self, a_id, year):
+        shutil.rmtree(self.folder / str(a_id) / year,
+            ignore_errors=True)
+
+    def save_partition(self, a_id, year, df):
+        path = self.folder / str(a_id) / year
+        tmp = path.with_name(f'{year}.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        df = df.sort_values(self.time_col,
+            kind='stable')
+        columns = {c: self.write_column(tmp, c, df[c])
+            for c in df.columns}
+        with open(tmp / 'meta.json', 'w') as f:
+            json.dump({'version': self.version,
+                'rows': len(df), 'columns': columns},
+                f, indent=1)
+        old = path.with_name(f'{year}.old')
+        if path.exists():
+            os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def write_column(self, path, name, col):
+        fname = name.replace('/', '__')
+        null = col.isna().to_numpy()
+        arrays = {}
+        if name == 'coords':
+            kind = 'coords'
+            lens = [0 if n else len(x) for x, n in
+                zip(col, null)]
+            flat = np.array([p for x, n in zip(col, null)
+                if not n for p in x], dtype=np.float64
+                ).reshape(-1, 2)
+            arrays['lat'] = flat[:, 0]
+            arrays['lon'] = flat[:, 1]
+            arrays['offsets'] = np.concatenate([[0],
+                np.cumsum(lens, dtype=np.int64)])
+        else:
+            kind, values = self.get_kind(col[~null])
+            if kind == 'str':
+                encoded = [v.encode() for v in values]
+                arrays['blob'] = np.frombuffer(
+                    b''.join(encoded), dtype=np.uint8)
+                arrays['offsets'] = np.concatenate(
+                    [[0], np.cumsum([len(v) for v in
+                    encoded], dtype=np.int64)]
+                    ).astype(np.int64)
+            else:
+                arrays['values'] = values
+        if null.any():
+            arrays['null'] = null
+        for key, arr in arrays.items():
+            np.save(path / f'{fname}.{key}.npy',
+                np.ascontiguousarray(arr),
+                allow_pickle=False)
+        return {'kind': kind, 'dtype': str(col.dtype),
+            'arrays': sorted(arrays)}
+
+    def get_kind(self, values):
+        # Non-null values of a column as int64, float64,
+        # bool or str. Strings stay strings, even when they
+        # look like numbers
+        if values.dtype.kind in 'iub':
+            return 'int64', values.to_numpy(
+                dtype=np.int64)
+        if values.dtype.kind == 'f':
+            return 'float64', values.to_numpy(
+                dtype=np.float64)
+        if len(values) and values.map(
+            lambda x: isinstance(x, (bool, np.bool_))
+            ).all():
+            return 'bool', values.to_numpy(
+                dtype=np.bool_)
+        is_str = values.map(
+            lambda x: isinstance(x, str)).any()
+        num = pd.to_numeric(values, errors='coerce') \
+            if not is_str else None
+        if len(values) and not is_str and \
+            num.notna().all():
+            if (num % 1 == 0).all():
+                return 'int64', num.to_numpy(
+                    dtype=np.int64)
+            return 'float64', num.to_numpy(
+                dtype=np.float64)
+        return 'str', values.astype(str).tolist()
+
+    def read_column(self, path, name, column, rows):
+        fname = name.replace('/', '__')
+        arrays = {key: np.load(
+            path / f'{fname}.{key}.npy',
+            allow_pickle=False)
+            for key in column['arrays']}
+        null = arrays.get('null',
+            np.zeros(rows, dtype=np.bool_))
+        kind = column['kind']
+        if kind == 'coords':
+            lat = arrays['lat'].tolist()
+            lon = arrays['lon'].tolist()
+            offsets = arrays['offsets'].tolist()
+            out = np.empty(rows, dtype=object)
+            out[:] = [np.nan if n else tuple(zip(
+                lat[s:e], lon[s:e])) for s, e, n in
+                zip(offsets[:-1], offsets[1:], null)]
+            return out
+        if kind == 'str':
+            blob = arrays['blob'].tobytes()
+            offsets = arrays['offsets'].tolist()
+            values = [blob[s:e].decode() for s, e in
+                zip(offsets[:-1], offsets[1:])]
+        else:
+            values = arrays['values']
+        # Partitions written without dtypes read as
+        # str, or as float64 when a number is missing
+        dtype = pd.api.types.pandas_dtype(
+            column.get('dtype', 'object' if kind ==
+            'str' else 'float64' if null.any()
+            else kind))
+        if not null.any() and kind != 'str' and \
+            isinstance(dtype, np.dtype) and \
+            dtype != object:
+            return np.asarray(values).astype(dtype)
+        out = np.full(rows, np.nan, dtype=object)
+        out[~null] = values if kind == 'str' else \
+            values.tolist()
+        if dtype == object:
+            return out
+        # Also nullable and tz aware pandas dtypes
+        col = pd.Series(out, dtype=object).astype(dtype)
+        return col.to_numpy() if isinstance(dtype,
+            np.dtype) else col.array
+
+    def migrate(self, pickles):
+        """
+        Copies the athletes of per athlete pickle files
+        into the store. Athletes already in the store
+        are skipped, the pickle files are kept.
+        """
+        for fname in pickles:
+            m = re.search(r'data_(\d+)\.pickle$', fname)
+            if not m or self.has_athlete(m.group(1)):
+                continue
+            df = pd.read_pickle(fname)
+            if len(df) == 0:
+                continue
+            a_ids = set(df['athlete/id'].astype(
+                np.int64))
+            if all(self.has_athlete(a_id)
+                for a_id in a_ids):
+                continue
+            print(f'Migrating {fname} into the '
+                f'activity store {self.folder}')
+            self.save(df[~df['athlete/id'].astype(
+                np.int64).map(self.has_athlete)])
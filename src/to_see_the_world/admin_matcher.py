@@ -0,0 +1,110 @@
+#!/usr/bin/env python3.11
+import os
+from pathlib import Path
+import pickle
+
+import numpy as np
+from rapidfuzz import fuzz as rfuzz
+from rapidfuzz import process as rprocess
+from thefuzz import fuzz
+from thefuzz.utils import full_process
+
+
+class AdminMatcher:
+    """
+    Matches visited admin names to the official admin
+    areas of a country. The official names of every
+    country are normalized once, unseen names are
+    scored in one batch and every answer is memoized
+    as (country_code, visited name) -> (admin_name,
+    admin_type), or False when nothing matches.
+    """
+    def __init__(self, df_country_data, ratio=70,
+        limit=5, fname='', version=''):
+        self.ratio = ratio
+        self.limit = limit
+        self.fname = fname
+        self.version = f'{version}:{ratio}:{limit}'
+        self.index = {}
+        for cc, dfc in df_country_data.groupby(
+            'country_code', sort=False):
+            tuple_adm = sorted(zip(
+                dfc.admin_name, dfc.admin_type))
+            names = [x[0] for x in tuple_adm]
+            self.index[cc] = (tuple_adm, names,
+                [full_process(x) for x in names],
+                dict(tuple_adm))
+        self.memo = {}
+        self.dirty = False
+        if self.fname:
+            self.load()
+
+    def get_tuple_adm(self, cc):
+        if cc not in self.index:
+            return []
+        return list(self.index[cc][0])
+
+    def match(self, cc, visits):
+        new = sorted({v for v in visits
+            if (cc, v) not in self.memo})
+        if new:
+            self.memo.update(zip(
+                [(cc, v) for v in new],
+                self.match_batch(cc, new)))
+            self.dirty = True
+        return [self.memo[(cc, v)] for v in visits]
+
+    def match_batch(self, cc, visits):
+        # Same answers as process.extract(visit,
+        # names, scorer=fuzz.ratio) followed by the
+        # partial_ratio fallback over its matches
+        if cc not in self.index:
+            return [False] * len(visits)
+        _, names, processed, types = self.index[cc]
+        scores = rprocess.cdist(
+            [full_process(v) for v in visits],
+            processed, scorer=rfuzz.ratio,
+            dtype=np.float64)
+        top = np.argsort(-scores, axis=1,
+            kind='stable')[:, :self.limit]
+        ans = []
+        for visit, row, cand in zip(
+            visits, scores, top):
+            found = False
+            if int(round(row[cand[0]])) >= self.ratio:
+                found = names[cand[0]]
+            else:
+                for i in cand:
+                    if fuzz.partial_ratio(
+                        visit, names[i]) >= self.ratio:
+                        found = names[i]
+                        break
+            ans.append(
+                (found, types[found]) if found else False)
+        return ans
+
+    def load(self):
+        try:
+            with open(self.fname, 'rb') as f:
+                data = pickle.load(f)
+        except (FileNotFoundError, EOFError,
+            pickle.UnpicklingError):
+            return
+        if data.get('version') != self.version:
+            print('Admin match memo is out of date. '
+                'Starting a new one.')
+            return
+        self.memo = data['memo']
+
+    def save(self):
+        if not self.fname or not self.dirty:
+            return
+        Path(self.fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{self.fname}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': self.version,
+                'memo': self.memo}, f,
+                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.fname)
+        self.dirty = False
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3.11
+from abc import ABC, abstractmethod
+from ast import literal_eval
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class CompiledArrays(ABC):
+    """
+    Directory of .npy arrays compiled from a source
+    file. The directory sits next to the source and is
+    rebuilt whenever the content hash of the source
+    or the build parameters change. Arrays are
+    memory-mapped on load.
+    """
+    version = 1
+    suffix = '.index'
+    _loaded = {}
+
+    def __init__(self, fname_source, rebuild=False):
+        self.fname_source = Path(fname_source)
+        self.folder = self.fname_source.with_suffix(
+            self.suffix)
+        self.arrays = {}
+        meta = self.read_meta()
+        if rebuild or not self.is_current(meta):
+            self.build()
+        self.load()
+
+    @classmethod
+    def load_cached(cls, fname_source, **params):
+        # One instance per file, parameters and process,
+        # shared by every caller
+        key = (cls.__name__,
+            str(Path(fname_source).resolve()),
+            tuple(sorted(params.items())))
+        compiled = cls._loaded.get(key)
+        if compiled is None or not compiled.is_current(
+            compiled.read_meta()):
+            compiled = cls(fname_source, **params)
+            cls._loaded[key] = compiled
+        return compiled
+
+    def get_params(self):
+        # Build parameters stored in the meta data
+        return {}
+
+    def get_source_stat(self):
+        stat = os.stat(self.fname_source)
+        return {'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+    def get_source_hash(self):
+        h = hashlib.sha256()
+        with open(self.fname_source, 'rb') as f:
+            for chunk in iter(
+                lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def read_meta(self):
+        try:
+            with open(self.folder / 'meta.json') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_meta(self, meta):
+        tmp = self.folder / 'meta.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp, self.folder / 'meta.json')
+
+    def is_current(self, meta):
+        if meta.get('version') != self.version or \
+            meta.get('params', {}) != self.get_params():
+            return False
+        stat = self.get_source_stat()
+        if all(meta.get(k) == stat[k] for k in stat):
+            return True
+        # The file was touched. Only rebuild when the
+        # content actually changed.
+        if meta.get('sha256') != self.get_source_hash():
+            return False
+        meta.update(stat)
+        self.write_meta(meta)
+        return True
+
+    def build(self):
+        print(f'Compiling {self.fname_source} into '
+            f'{self.folder}')
+        self.folder.mkdir(parents=True, exist_ok=True)
+        arrays = self.compile()
+        for name, arr in arrays.items():
+            np.save(self.folder / f'{name}.npy',
+                np.ascontiguousarray(arr),
+                allow_pickle=False)
+        self.after_build(arrays)
+        meta = {'version': self.version,
+            'params': self.get_params(),
+            'source': self.fname_source.name,
+            'sha256': self.get_source_hash(),
+            'arrays': sorted(arrays)}
+        meta.update(self.get_source_stat())
+        self.write_meta(meta)
+
+    def load(self):
+        for name in self.read_meta()['arrays']:
+            self.arrays[name] = np.load(
+                self.folder / f'{name}.npy',
+                mmap_mode='r', allow_pickle=False)
+
+    @abstractmethod
+    def compile(self):
+        # name -> array of everything to be saved
+        pass
+
+    def after_build(self, arrays):
+        pass
+
+
+class CompiledTable(CompiledArrays):
+    """
+    Typed columns of a csv. Numeric columns are float64
+    arrays. String columns are int32 codes into their
+    sorted unique values, which are kept as one utf-8
+    blob with offsets and only decoded when asked for.
+    """
+    numeric = []
+    strings = []
+    sort_by = ''
+
+    def __init__(self, fname_source, rebuild=False):
+        self.decoded = {}
+        super().__init__(fname_source, rebuild=rebuild)
+
+    def read_source(self):
+        return pd.read_csv(
+            self.fname_source, na_filter = False,
+            usecols=self.numeric + self.strings,
+            dtype={c: str for c in self.strings})
+
+    def compile(self):
+        df = self.read_source()
+        if self.sort_by:
+            df = df.sort_values(
+                by=self.sort_by, kind='stable')
+        arrays = {}
+        for col in self.numeric:
+            arrays[col] = df[col].to_numpy(
+                dtype=np.float64)
+        for col in self.strings:
+            codes, values = pd.factorize(
+                df[col], sort=True)
+            encoded = [v.encode() for v in values]
+            arrays[f'{col}_codes'] = codes.astype(
+                np.int32)
+            arrays[f'{col}_offsets'] = np.concatenate(
+                [[0], np.cumsum([len(v) for v in encoded],
+                dtype=np.int64)]).astype(np.int64)
+            arrays[f'{col}_blob'] = np.frombuffer(
+                b''.join(encoded),
+                dtype=np.uint8)
+        return arrays
+
+    def __len__(self):
+        col = self.numeric[0] if self.numeric else \
+            f'{self.strings[0]}_codes'
+        return len(self.arrays[col])
+
+    def get_values(self, col):
+        # All unique values of a string column
+        if col not in self.decoded:
+            offsets = self.arrays[f'{col}_offsets']
+            self.decoded[col] = self.decode_values(
+                col, np.arange(len(offsets) - 1))
+        return self.decoded[col]
+
+    def decode_values(self, col, codes):
+        blob = self.arrays[f'{col}_blob']
+        offsets = self.arrays[f'{col}_offsets']
+        ans = np.empty(len(codes), dtype=object)
+        ans[:] = [bytes(blob[offsets[c]:offsets[c + 1]]
+            ).decode() for c in codes]
+        return ans
+
+    def find_rows(self, col, value):
+        # Rows where a string column equals value
+        values = self.get_values(col)
+        code = np.searchsorted(values, value)
+        if code >= len(values) or values[code] != value:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(
+            self.arrays[f'{col}_codes'] == code)
+
+    def get_column(self, col, rows=slice(None)):
+        if col in self.numeric:
+            return np.array(self.arrays[col][rows])
+        codes = np.asarray(
+            self.arrays[f'{col}_codes'][rows])
+        if col in self.decoded:
+            return self.decoded[col][codes]
+        uniq, inverse = np.unique(
+            codes, return_inverse=True)
+        return self.decode_values(col, uniq)[inverse]
+
+    def to_frame(self, columns=None):
+        columns = columns or self.numeric + self.strings
+        return pd.DataFrame({
+            col: self.get_column(col) for col in columns})
+
+
+class CityTable(CompiledTable):
+    """
+    cities500 sorted by country so the rows of one
+    country are a contiguous slice.
+    """
+    numeric = ['lat', 'lon']
+    strings = ['cc', 'admin1', 'name']
+    sort_by = 'cc'
+
+    def compile(self):
+        arrays = super().compile()
+        arrays['cc_row_offsets'] = np.concatenate([[0],
+            np.cumsum(np.bincount(arrays['cc_codes'],
+            minlength=len(arrays['cc_offsets']) - 1))
+            ]).astype(np.int64)
+        return arrays
+
+    def get_rows(self, cc):
+        values = self.get_values('cc')
+        code = np.searchsorted(values, cc)
+        if code >= len(values) or values[code] != cc:
+            return slice(0, 0)
+        offsets = self.arrays['cc_row_offsets']
+        return slice(int(offsets[code]),
+            int(offsets[code + 1]))
+
+
+class CountryTable(CompiledTable):
+    """
+    country_data with the country_centroid strings
+    parsed once into centroid_lat/centroid_lon.
+    """
+    strings = ['admin_name', 'country_name',
+        'country_code', 'admin_type']
+
+    def read_source(self):
+        return pd.read_csv(
+            self.fname_source, na_filter = False,
+            dtype=str)
+
+    def compile(self):
+        arrays = super().compile()
+        df = self.read_source()
+        centroids = np.array([
+            literal_eval(x) for x in
+            df['country_centroid']], dtype=np.float64
+            ).reshape(-1, 2)
+        arrays['centroid_lat'] = centroids[:, 0]
+        arrays['centroid_lon'] = centroids[:, 1]
+        return arrays
+
+    def to_frame(self, columns=None):
+        # country_centroid is made of the parsed
+        # centroid_lat/centroid_lon tuples
+        centroid = columns is None or \
+            'country_centroid' in columns
+        if columns is not None:
+            columns = [c for c in columns
+                if c != 'country_centroid']
+        df = super().to_frame(columns)
+        if centroid:
+            df['country_centroid'] = list(zip(
+                self.arrays['centroid_lat'].tolist(),
+                self.arrays['centroid_lon'].tolist()))
+        return df
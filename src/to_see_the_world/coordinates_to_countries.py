@@ -1,16 +1,38 @@
 #!/usr/bin/env python3.13
+from concurrent.futures import ProcessPoolExecutor
 import configparser
-import math
+import os
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from scipy.spatial import KDTree
 
+from geo_index import BoundaryIndex, CityIndex, InteriorGrid
+from geocode_cache import GeocodeCache
+from point_in_polygon import PointInPolygon
 from update_local_data2 import Datasets
 
-import time
 
+# Worker side of CoordinatesToCountries.run_parallel.
+# Each process keeps one instance. Workers memory-map
+# the compiled boundary index and city table (the OS
+# shares those pages) but build their own KDTrees.
+# Nothing depends on the start method, spawned workers
+# load the same compiled folders. Queries use one
+# thread each, the processes are the parallelism.
+_worker_ctc = None
+
+
+def _init_worker():
+    global _worker_ctc
+    _worker_ctc = CoordinatesToCountries(
+        geocode_cache=False, workers=1,
+        query_workers=1)
+
+
+def _run_shard(coords):
+    df = _worker_ctc.get_geodata(coords)
+    return _worker_ctc.run_exact(df)
 
 
 class CoordinatesToCountries:
@@ -18,208 +40,411 @@ class CoordinatesToCountries:
         fname_country_data='fname_country_data',
         fname_cb_shifted=
         'fname_country_boundaries_shifted',
-        fname_cities='fname_cities500'):
+        fname_cities='fname_cities500',
+        geocode_cache=None, workers=None,
+        query_workers=-1):
         self.config = configparser.ConfigParser()
         self.config.read('config.ini')
         self.pwd = Path.cwd()
-        self.df_cb_shifted = \
-            self.setup_data(fname_cb_shifted)
-        self.df_city = self.setup_data(fname_cities)
+        fname_cbs = self.config.get(
+            'path', fname_cb_shifted)
+        self.BI = BoundaryIndex.load_cached(
+            f'{self.pwd}/{fname_cbs}')
+        self.PIP = PointInPolygon()
+        fname_city = self.config.get(
+            'path', fname_cities)
+        self.CI = CityIndex.load_cached(
+            f'{self.pwd}/{fname_city}')
+        self.IG = None
+        if self.config.getboolean(
+            'interior_grid', 'enabled', fallback=False):
+            self.IG = InteriorGrid.load_cached(
+                f'{self.pwd}/{fname_cbs}',
+                cell_deg=self.config.getfloat(
+                'interior_grid', 'cell_deg',
+                fallback=0.1))
         self.Datasets = Datasets()
+        if geocode_cache is None:
+            geocode_cache = self.config.getboolean(
+                'geocode_cache', 'enabled',
+                fallback=False)
+        self.GC = self.setup_geocode_cache(
+            ) if geocode_cache else None
+        if workers is None:
+            workers = self.config.getint(
+                'data', 'geo_workers', fallback=1)
+        self.workers = workers if workers > 0 else \
+            os.cpu_count()
+        self.min_parallel_points = self.config.getint(
+            'data', 'geo_min_parallel_points',
+            fallback=20000)
+        # scipy workers of the KDTree queries
+        self.query_workers = query_workers
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def run(self, coords):
-        df = self.get_geodata_kdtree(coords)
-        fids = set(list(df['fid'].explode()))
+        if self.GC is not None:
+            return self.run_cached(coords)
+        if self.workers > 1 and len(coords['id']) >= \
+            self.min_parallel_points:
+            return self.run_parallel(coords)
+        df = self.get_geodata(coords)
+        return self.run_exact(df)
+
+    def run_exact(self, df):
+        # Sorted, so a point inside both of its polygons
+        # gets the same one in any batch
+        fids = sorted(set(df['fid']) | set(
+            df['fid2'].dropna()))
         df = self.check_polygon(df, fids)
         df = self.fix_outliers(df)
         df = self.get_closest_admin(df
-            ).sort_values(by=['id'], ascending=True)
+            ).sort_values(by=['id'], ascending=True,
+            kind='stable')
         return df
-        
-    def setup_data(self, fname):
-        f = self.config.get('path', fname)
-        return pd.read_csv(
-            f'{self.pwd}/{f}', na_filter = False)
 
-    def get_geodata_kdtree(self, coords):
-        tott = 0
-        data = list(zip(
-            list(self.df_cb_shifted['lat']),
-            list(self.df_cb_shifted['lon'])))
-        tree = KDTree(data, leafsize=30)
-        _, ii = tree.query(coords['coords'], k=2,
-            workers=-1)
-        geo_data = {
-            'id': [], 'og_coord': [], 'fid': [],
-            'country_code': []}
-        for idx, i in enumerate(ii):
-            cc = []
-            fid = []
-            geo_data['id'].append(coords['id'][idx])
-            og_coord = coords['coords'][idx]
-            for ix in i:
-                cc_ans = self.df_cb_shifted.iloc[[ix]
-                    ].country_code.values[0]
-                if cc_ans not in cc:
-                    cc.append(cc_ans)
-                fid_ans = self.df_cb_shifted.iloc[[
-                    ix]].fid.values[0]
-                if fid_ans not in fid:
-                    fid.append(fid_ans)
-            geo_data['fid'].append(fid)
-            geo_data['country_code'].append(cc)
-            geo_data['og_coord'].append(og_coord)
-        return pd.DataFrame(geo_data)
-        
-    def points_in_polygon(self, points, poly):
+    def run_parallel(self, coords, shard_deg=5.0):
+        """
+        Shards the points by region (whole shard_deg
+        grid cells) and resolves the shards in a
+        process pool. Results are merged back in id
+        order with the input point order kept inside
+        each id, the same as the serial path.
+        """
+        points = np.asarray(
+            coords['coords'], dtype=np.float64
+            ).reshape(-1, 2)
+        ids = np.asarray(coords['id'])
+        cells = np.floor((points[:, 0] + 90
+            ) / shard_deg) * 1000 + np.floor((
+            points[:, 1] + 180) / shard_deg)
+        order = np.argsort(cells, kind='stable')
+        sorted_cells = cells[order]
+        cell_starts = np.flatnonzero(np.r_[True,
+            sorted_cells[1:] != sorted_cells[:-1]])
+        # Cut at the cell start closest to an even split
+        num_shards = min(len(cell_starts),
+            self.workers * 4)
+        even = np.arange(1, num_shards) * len(order
+            ) / num_shards
+        cuts = np.unique(cell_starts[np.clip(
+            np.searchsorted(cell_starts, even), 0,
+            len(cell_starts) - 1)])
+        shards = []
+        for pos in np.split(order, cuts):
+            pos = np.sort(pos)
+            # Positions stand in for ids so the merge
+            # can restore the input order
+            shards.append({'id': pos, 'coords': list(
+                map(tuple, points[pos].tolist()))})
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker)
+        print(f'Resolving {len(ids)} points in '
+            f'{len(shards)} shards on {self.workers} '
+            'processes')
+        df = pd.concat(list(self.pool.map(
+            _run_shard, shards)), ignore_index=True)
+        df = df.sort_values(by=['id'], kind='stable')
+        og_coord = list(coords['coords'])
+        df['og_coord'] = pd.Series(
+            [og_coord[i] for i in df['id']],
+            index=df.index, dtype=object)
+        df['id'] = ids[df['id'].to_numpy()]
+        return df.sort_values(by=['id'], ascending=True,
+            kind='stable')
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def run_chunks(self, chunks):
         """
-        Checks if a set of points are inside a given
-        polygon using the ray casting algorithm.
+        Streaming version of run.
         Args:
-            points (list of tuples): List of (x, y)
-            coordinates of points to check.
-            poly (list of tuples): List of (x, y)
-            coordinates of the polygon vertices.
-        Returns:
-            ans (list of tuples): points that are in the
-            polygon
+            chunks (iterable): (id, lat, lon) arrays.
+            Points of one id should not be split
+            across chunks.
+        Yields:
+            one resolved DataFrame per chunk
         """
-        # 1. Convert inputs to numpy arrays for
-        # efficient computation
-        x = np.array([point[0] for point in points])
-        y = np.array([point[1] for point in points])
-        # 2. Extract polygon vertices (using wrap
-        # -around for edges)
-        poly_x = np.array([p[0] for p in poly])
-        poly_y = np.array([p[1] for p in poly])
-        # 3. Initialize results and vertex count
-        n = len(poly)
-        # The 'inside' array tracks how many
-        # intersections were found for each point
-        # We use boolean type and flip its state 
-        # when an odd number of intersections is
-        # counted
-        inside = np.zeros(len(x), dtype=np.bool_)
-        # 4. Iterate over each edge of the polygon
-        for i in range(n):
-            p1x, p1y = poly_x[i], poly_y[i]
-            p2x, p2y = poly_x[(i + 1) % n], poly_y[
-                (i + 1) % n]
-            # 5. The core logic of the ray casting
-            # algorithm:
-            # Check if the ray cast horizontally from
-            # the point intersects the edge [1]
-            # Check if the edge crosses the point's 
-            # y-height (y lies between p1y and p2y)
-            condition1 = (p1y <= y) & (p2y > y)
-            condition2 = (p2y <= y) & (p1y > y)
-            # Check if the intersection point of the
-            # edge is to the right of the point [1]
-            den = p2y - p1y
-            if den == 0:
-                intersect_x = p1x
-            else:
-                intersect_x = (p2x - p1x) * (y - p1y
-                    ) / den + p1x
-            condition3 = x < intersect_x
-            # If all conditions are met for a specific
-            # point and edge, flip the 'inside' state 
-            # for that point [1]
-            # An even number of flips means outside;
-            # an odd number means inside
-            mask = (condition1 | condition2
-                ) & condition3
-            inside[mask] = ~inside[mask]
-        ans = [point for idx, point in enumerate(
-            points) if inside[idx]]
-        return ans
+        for ids, lat, lon in chunks:
+            if len(ids) == 0:
+                continue
+            yield self.run({'id': ids, 'coords': list(
+                zip(np.asarray(lat).tolist(),
+                np.asarray(lon).tolist()))})
+
+    def run_cached(self, coords):
+        points = np.asarray(
+            coords['coords'], dtype=np.float64
+            ).reshape(-1, 2)
+        ids = np.asarray(coords['id'])
+        hit, (fid, cc, admin_name, city) = \
+            self.GC.lookup(points[:, 0], points[:, 1])
+        miss = np.flatnonzero(~hit)
+        og_coord = list(coords['coords'])
+        # Positions stand in for ids, like in
+        # run_parallel, so the hits and the resolved
+        # misses merge back in the input point order
+        df = self.get_geodata({
+            'id': miss,
+            'coords': [og_coord[i] for i in miss]})
+        # Border cells are near a polygon edge, not just
+        # near a vertex, vertices are sparse along
+        # straight borders
+        border = df['fid2'].notna().to_numpy() | (
+            self.BI.get_edge_distance(df['lat'], df['lon'])
+            < self.border_deg)
+        self.GC.mark_border(df['lat'].to_numpy()[border],
+            df['lon'].to_numpy()[border])
+        df = self.run_exact(df)
+        lat_lon = np.asarray(list(df['og_coord']),
+            dtype=np.float64).reshape(-1, 2)
+        self.GC.update(lat_lon[:, 0], lat_lon[:, 1],
+            df['fid'], df['country_code'],
+            df['admin_name'], df['city'])
+        df_hit = pd.DataFrame({
+            'id': np.flatnonzero(hit),
+            'fid': fid.astype(self.BI.fid_values.dtype),
+            'country_code': cc,
+            'og_coord': pd.Series(
+                [og_coord[i] for i in np.flatnonzero(hit)],
+                dtype=object),
+            'admin_name': admin_name,
+            'city': city})
+        df = pd.concat([df, df_hit], ignore_index=True
+            ).sort_values(by=['id'], kind='stable')
+        df['id'] = ids[df['id'].to_numpy()]
+        df = df.sort_values(by=['id'], ascending=True,
+            kind='stable')
+        if self.config.getboolean(
+            'geocode_cache', 'persist', fallback=False):
+            self.GC.save()
+        return df
+
+    def setup_geocode_cache(self):
+        self.border_deg = self.config.getfloat(
+            'geocode_cache', 'border_deg',
+            fallback=0.05)
+        fname = ''
+        if self.config.getboolean(
+            'geocode_cache', 'persist', fallback=False):
+            fname = f'{self.pwd}/' + self.config.get(
+                'path', 'fname_geocode_cache')
+        return GeocodeCache(
+            cell_deg=self.config.getfloat(
+                'geocode_cache', 'cell_deg',
+                fallback=0.001),
+            max_cells=self.config.getint(
+                'geocode_cache', 'max_cells',
+                fallback=500000),
+            fname=fname,
+            version=self.get_version())
+
+    def get_version(self):
+        # Everything the answers depend on: the
+        # boundary data and the interior grid settings
+        grid = 'off' if self.IG is None else \
+            self.IG.cell_deg
+        return (f"{self.BI.read_meta().get('sha256', '')}"
+            f':grid={grid}')
+
+    def get_geodata(self, coords):
+        """
+        get_geodata_kdtree for the points that are not
+        in an interior cell of the interior grid. Those
+        take the fid and country_code of their cell.
+        Rows keep the input order.
+        """
+        if self.IG is None:
+            return self.get_geodata_kdtree(coords)
+        points = np.asarray(
+            coords['coords'], dtype=np.float64
+            ).reshape(-1, 2)
+        codes = self.IG.lookup(points[:, 0], points[:, 1])
+        exact = np.flatnonzero(codes < 0)
+        if len(exact) == len(codes):
+            return self.get_geodata_kdtree(coords)
+        og_coord = list(coords['coords'])
+        ids = np.asarray(coords['id'])
+        df = self.get_geodata_kdtree({
+            'id': ids[exact],
+            'coords': [og_coord[i] for i in exact]})
+        interior = np.flatnonzero(codes >= 0)
+        fid_codes = codes[interior]
+        og_interior = np.empty(len(interior), dtype=object)
+        og_interior[:] = [og_coord[i] for i in interior]
+        df_interior = pd.DataFrame({
+            'id': ids[interior],
+            'og_coord': og_interior,
+            'lat': points[interior, 0],
+            'lon': points[interior, 1],
+            'dist': np.nan,
+            'fid': self.BI.fid_values[fid_codes],
+            'fid2': np.nan,
+            'country_code': self.BI.cc_values[
+                self.BI.arrays['poly_cc_codes'][
+                fid_codes]].astype(object),
+            'country_code2': ''})
+        df = pd.concat([df, df_interior],
+            ignore_index=True)
+        return df.iloc[np.argsort(np.concatenate(
+            [exact, interior]), kind='stable')
+            ].reset_index(drop=True)
 
+    def get_geodata_kdtree(self, coords):
+        """
+        Finds the two closest boundary points for every
+        coordinate. fid/country_code hold the closest
+        match. fid2/country_code2 hold the second match
+        only when it differs (NaN and '' otherwise), so
+        a row is ambiguous when fid2 is set.
+        """
+        points = np.asarray(
+            coords['coords'], dtype=np.float64
+            ).reshape(-1, 2)
+        dd, ii = self.BI.tree.query(
+            points, k=2, workers=self.query_workers)
+        fid_codes = self.BI.fid_codes[ii]
+        cc_codes = self.BI.cc_codes[ii]
+        fid = self.BI.fid_values[fid_codes]
+        cc = self.BI.cc_values[cc_codes].astype(object)
+        fid2 = np.where(
+            fid_codes[:, 1] != fid_codes[:, 0],
+            fid[:, 1], np.nan)
+        cc2 = np.where(
+            cc_codes[:, 1] != cc_codes[:, 0],
+            cc[:, 1], '')
+        og_coord = np.empty(len(ii), dtype=object)
+        og_coord[:] = list(coords['coords'])
+        return pd.DataFrame({
+            'id': np.asarray(coords['id']),
+            'og_coord': og_coord,
+            'lat': points[:, 0],
+            'lon': points[:, 1],
+            'dist': dd[:, 0],
+            'fid': fid[:, 0],
+            'fid2': fid2,
+            'country_code': cc[:, 0],
+            'country_code2': cc2})
+        
     def check_polygon(self, df, fids, by_fid=True):
-        #fids = set(list(df['fid'].explode()))
-        df['fid'] = df['fid'].apply(lambda x: x[0
-            ] if isinstance(x, list) and len(x) == 1 else x)
-        df['country_code'] = df['country_code'
-            ].apply(lambda x: x[0
-            ] if isinstance(x, list) and len(x) == 1 else x)
-        for fid in fids:
-            cc = self.df_cb_shifted.get(
-                self.df_cb_shifted.fid == fid
-                )['country_code'].values[0]
-            poly = list(self.df_cb_shifted.get(
-                self.df_cb_shifted.fid == fid
-                ).apply(lambda row: [row['lat'],
-                row['lon']], axis=1))
-            dfb = df[df['fid'].apply(
-                lambda x: isinstance(x, list))]
-            if len(dfb) == 0:
-                continue
-            if by_fid:
-                point = list(dfb[dfb['fid'].apply(
-                    lambda x: fid in x)]['og_coord'])
-            else:
-                point = list(dfb[dfb['country_code'].apply(
-                    lambda x: cc in x)]['og_coord'])
-            inside = self.points_in_polygon(
-                    point, poly)
-            df.loc[df.og_coord.isin(inside), 'fid'] = fid
-            df.loc[df.og_coord.isin(inside
-                ), 'country_code'] = cc
+        # Candidate points for each polygon come from the
+        # bbox grid of the boundary index, limited to
+        # ambiguous points that list the polygon's fid
+        # (or country_code when by_fid is False)
+        amb = df['fid2'].notna().to_numpy()
+        if len(fids) == 0 or not amb.any():
+            return df
+        rows = np.flatnonzero(amb)
+        point_idx, fid_codes = self.BI.query_bbox(
+            df['lat'].to_numpy()[rows],
+            df['lon'].to_numpy()[rows])
+        if by_fid:
+            key = fid_codes
+            key1 = self.BI.get_fid_codes(
+                df['fid'].to_numpy()[rows])
+            key2 = self.BI.get_fid_codes(
+                df['fid2'].to_numpy()[rows])
+        else:
+            key = self.BI.arrays['poly_cc_codes'][
+                fid_codes]
+            key1 = self.BI.get_cc_codes(
+                df['country_code'].to_numpy()[rows])
+            key2 = self.BI.get_cc_codes(
+                df['country_code2'].to_numpy()[rows])
+        match = (key == key1[point_idx]) | (
+            key == key2[point_idx])
+        # Test every candidate pair in one batch. Each
+        # row takes the first polygon, in fids order,
+        # that holds it. Rows are addressed by position
+        point_idx = point_idx[match]
+        fid_codes = fid_codes[match]
+        fids = list(fids)
+        fids_codes, first = np.unique(
+            self.BI.get_fid_codes(fids),
+            return_index=True)
+        rank = np.full(len(self.BI.fid_values) + 1,
+            len(fids), dtype=np.int64)
+        rank[fids_codes] = first
+        ranked = rank[fid_codes] < len(fids)
+        point_idx = point_idx[ranked]
+        fid_codes = fid_codes[ranked]
+        inside = self.PIP.run(
+            df['lat'].to_numpy()[rows],
+            df['lon'].to_numpy()[rows],
+            point_idx, fid_codes, self.BI.get_polygon)
+        hit_rows = rows[point_idx[inside]]
+        hit_codes = fid_codes[inside]
+        order = np.lexsort((rank[hit_codes], hit_rows))
+        hit_rows = hit_rows[order]
+        hit_codes = hit_codes[order]
+        winner = np.ones(len(hit_rows), dtype=np.bool_)
+        winner[1:] = hit_rows[1:] != hit_rows[:-1]
+        hit_rows = hit_rows[winner]
+        hit_codes = hit_codes[winner]
+        for col, values in [
+            ('fid', self.BI.fid_values[hit_codes]),
+            ('fid2', np.nan),
+            ('country_code', self.BI.cc_values[
+                self.BI.arrays['poly_cc_codes'][
+                hit_codes]].astype(object)),
+            ('country_code2', '')]:
+            arr = df[col].to_numpy(copy=True)
+            arr[hit_rows] = values
+            df[col] = arr
         return df
         
     def fix_outliers(self, df):
-        is_list_mask = df['country_code'].apply(
-            lambda x: isinstance(x, list))
-        fids = []
+        is_list_mask = df['country_code2'] != ''
         # Check all other polygons from the
         # same country_code. Solves issue when
-        # the closest point is next to an enclave
-        ccs = set(list(df[is_list_mask][
-            'country_code'].explode()))
-        for cc in ccs:
-            df_sub = df.get(df.country_code == cc)
-            fids.extend(list(set(list(
-                df_sub['fid'].explode()))))
+        # the closest point is next to an enclave.
+        # The polygons come from the boundary index, so
+        # the answer does not depend on the other rows
+        # of the batch
+        ccs = set(df[is_list_mask]['country_code']) | \
+            set(df[is_list_mask]['country_code2'])
+        fid_codes = np.flatnonzero(np.isin(
+            self.BI.arrays['poly_cc_codes'],
+            self.BI.get_cc_codes(sorted(ccs))))
         df = self.check_polygon(
-            df, fids, by_fid=False)
+            df, self.BI.fid_values[fid_codes],
+            by_fid=False)
         # drop any extra outliers
-        df = df[df['country_code'].apply(type) != list]
+        df = df[df['country_code2'] == '']
         return df
         
     def get_closest_admin(self, df_geo_data):
-        geo_data = {
-            'id': [],
-            'fid': [],
-            'country_code': [],
-            'og_coord': [],
-            'admin_name': [],
-            'city': []}
-        for cc in set(df_geo_data.country_code):
-            if not cc:
-                continue
-            sub_df_gd = df_geo_data.get(
-                df_geo_data.country_code == cc)
-            sub_df_c = self.df_city.get(
-                self.df_city.cc == cc)
-            geo_data['id'] += list(sub_df_gd['id'])
-            geo_data['fid'] += list(sub_df_gd['fid'])
-            geo_data['country_code'] += list(
-                sub_df_gd['country_code'])
-            og_coord = list(sub_df_gd[
-                'og_coord'])
-            geo_data['og_coord'
-                ] += og_coord
-            data = list(zip(
-                list(sub_df_c['lat']),
-                list(sub_df_c['lon'])))
-            tree = KDTree(data, leafsize=30)
-            _, ii = tree.query(og_coord, k=1,
-                workers=-1)
-            for i in ii:
-                geo_data['admin_name'].append(
-                    sub_df_c.iloc[[i]].admin1.values[0])
-                geo_data['city'].append(
-                    sub_df_c.iloc[[i]].name.values[0])
-        return pd.DataFrame(geo_data)
+        # Rows keep their input (point) order
+        df = df_geo_data.get(
+            df_geo_data.country_code != '')
+        lat = df['lat'].to_numpy()
+        lon = df['lon'].to_numpy()
+        admin_name = np.empty(len(df), dtype=object)
+        city = np.empty(len(df), dtype=object)
+        for cc, rows in df.groupby(
+            'country_code').indices.items():
+            admin_name[rows], city[rows] = \
+                self.CI.query(cc, lat[rows], lon[rows],
+                workers=self.query_workers)
+        return pd.DataFrame({
+            'id': df['id'].to_numpy(),
+            'fid': df['fid'].to_numpy(),
+            'country_code': df[
+                'country_code'].to_numpy(),
+            'og_coord': df['og_coord'].to_numpy(),
+            'admin_name': admin_name,
+            'city': city})
 
 
 if __name__ == "__main__":
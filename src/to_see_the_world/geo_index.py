@@ -0,0 +1,439 @@
+#!/usr/bin/env python3.11
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import KDTree
+
+from compiled_data import CityTable, CompiledArrays
+from point_in_polygon import PointInPolygon
+
+
+class BoundaryIndex(CompiledArrays):
+    """
+    Shifted country boundary points as a contiguous
+    (n, 2) lat/lon array with parallel fid and
+    country_code code arrays. The KDTree over the
+    memory-mapped points is built on first use, so
+    nothing scipy specific is stored.
+    Each fid is also a polygon. Its vertices are
+    points[poly_order[poly_offsets[i]:
+    poly_offsets[i + 1]]] in csv order, with a
+    bounding box, a country code and a bbox grid
+    (grid_deg cells) to look up polygons by point.
+    edge_points cut every polygon edge into pieces of
+    at most edge_step_deg, so distances to the edges
+    are not limited by how sparse the vertices are.
+    """
+    version = 4
+    grid_deg = 1.0
+    edge_step_deg = 0.01
+
+    def __init__(self, fname_source, rebuild=False):
+        self._tree = None
+        self._edge_tree = None
+        super().__init__(fname_source, rebuild=rebuild)
+
+    def compile(self):
+        df = pd.read_csv(
+            self.fname_source, na_filter = False)
+        points = df[['lat', 'lon']].to_numpy(
+            dtype=np.float64)
+        # fid keeps the csv dtype
+        fid_codes, fid_values = pd.factorize(
+            df['fid'], sort=True)
+        cc_codes, cc_values = pd.factorize(
+            df['country_code'].astype(str), sort=True)
+        arrays = {
+            'points': points,
+            'fid_codes': fid_codes.astype(np.int32),
+            'fid_values': np.asarray(fid_values),
+            'cc_codes': cc_codes.astype(np.int32),
+            'cc_values': np.asarray(
+                cc_values, dtype=str)}
+        arrays.update(self.compile_polygons(
+            points, arrays['fid_codes'],
+            arrays['cc_codes'], len(fid_values)))
+        arrays['edge_points'] = self.get_edge_pieces(
+            self.edge_step_deg,
+            points[arrays['poly_order']],
+            arrays['poly_offsets'])[0]
+        return arrays
+
+    def compile_polygons(self, points, fid_codes,
+        cc_codes, num_fid):
+        order = np.argsort(fid_codes, kind='stable')
+        offsets = np.zeros(num_fid + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(
+            fid_codes, minlength=num_fid))
+        sorted_points = points[order]
+        starts = offsets[:-1]
+        bbox = np.column_stack([
+            np.minimum.reduceat(
+                sorted_points[:, 0], starts),
+            np.minimum.reduceat(
+                sorted_points[:, 1], starts),
+            np.maximum.reduceat(
+                sorted_points[:, 0], starts),
+            np.maximum.reduceat(
+                sorted_points[:, 1], starts)])
+        r0, c0 = self.get_grid_cell(
+            bbox[:, 0], bbox[:, 1])
+        r1, c1 = self.get_grid_cell(
+            bbox[:, 2], bbox[:, 3])
+        _, num_cols = self.get_grid_shape()
+        cells = []
+        polys = []
+        for i in range(num_fid):
+            rr, cc = np.meshgrid(
+                np.arange(r0[i], r1[i] + 1),
+                np.arange(c0[i], c1[i] + 1))
+            cells.append((rr * num_cols + cc).ravel())
+            polys.append(np.full(rr.size, i))
+        cells = np.concatenate(cells)
+        polys = np.concatenate(polys)
+        grid_order = np.argsort(cells, kind='stable')
+        grid_offsets = np.zeros(
+            np.prod(self.get_grid_shape()) + 1,
+            dtype=np.int64)
+        grid_offsets[1:] = np.cumsum(np.bincount(
+            cells, minlength=len(grid_offsets) - 1))
+        return {
+            'poly_order': order.astype(np.int64),
+            'poly_offsets': offsets,
+            'poly_bbox': bbox,
+            'poly_cc_codes': cc_codes[order[starts]],
+            'grid_offsets': grid_offsets,
+            'grid_polys': polys[grid_order].astype(
+                np.int32)}
+
+    def get_edge_pieces(self, step_deg, points=None,
+        offsets=None):
+        """
+        Cuts every polygon edge into pieces whose lat
+        and lon extents are at most step_deg.
+        Returns the (start, end) points of the pieces.
+        """
+        if points is None:
+            order = self.arrays['poly_order']
+            points = self.points[order]
+            offsets = self.arrays['poly_offsets']
+        nxt = np.arange(1, len(points) + 1)
+        full = offsets[1:] > offsets[:-1]
+        nxt[offsets[1:][full] - 1] = offsets[:-1][full]
+        delta = points[nxt % max(len(points), 1)] - points
+        pieces = np.maximum(1, np.ceil(np.abs(
+            delta).max(axis=1, initial=0) / step_deg
+            )).astype(np.int64)
+        edge = np.repeat(np.arange(len(points)), pieces)
+        k = np.arange(len(edge)) - np.repeat(
+            np.cumsum(pieces) - pieces, pieces)
+        t0 = (k / pieces[edge])[:, None]
+        t1 = ((k + 1) / pieces[edge])[:, None]
+        return (points[edge] + delta[edge] * t0,
+            points[edge] + delta[edge] * t1)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            # The tree keeps a reference to the mapped
+            # points instead of a copy
+            self._tree = KDTree(self.points, leafsize=30,
+                copy_data=False)
+        return self._tree
+
+    @property
+    def edge_tree(self):
+        if self._edge_tree is None:
+            self._edge_tree = KDTree(
+                self.arrays['edge_points'], leafsize=30,
+                copy_data=False)
+        return self._edge_tree
+
+    def get_edge_distance(self, lat, lon, workers=-1):
+        """
+        Lower bound of the distance (deg) from every
+        point to the closest polygon edge. A piece is at
+        most edge_step_deg * sqrt(2) long, so no point
+        of it is further than half that from the
+        closest edge point.
+        """
+        points = np.column_stack([
+            np.asarray(lat, dtype=np.float64),
+            np.asarray(lon, dtype=np.float64)])
+        if len(points) == 0:
+            return np.zeros(0)
+        dd, _ = self.edge_tree.query(
+            points, k=1, workers=workers)
+        return np.maximum(
+            dd - self.edge_step_deg * np.sqrt(0.5), 0)
+
+    @property
+    def points(self):
+        return self.arrays['points']
+
+    @property
+    def fid_codes(self):
+        return self.arrays['fid_codes']
+
+    @property
+    def fid_values(self):
+        return self.arrays['fid_values']
+
+    @property
+    def cc_codes(self):
+        return self.arrays['cc_codes']
+
+    @property
+    def cc_values(self):
+        return self.arrays['cc_values']
+
+    def get_grid_shape(self):
+        return (int(round(180 / self.grid_deg)),
+            int(round(360 / self.grid_deg)))
+
+    def get_grid_cell(self, lat, lon):
+        num_rows, num_cols = self.get_grid_shape()
+        row = np.clip(np.floor(
+            (np.asarray(lat) + 90) / self.grid_deg
+            ).astype(np.int64), 0, num_rows - 1)
+        col = np.clip(np.floor(
+            (np.asarray(lon) + 180) / self.grid_deg
+            ).astype(np.int64), 0, num_cols - 1)
+        return row, col
+
+    def get_fid_codes(self, fids):
+        # -1 for NaN or unknown fids
+        fids = np.asarray(fids, dtype=np.float64)
+        values = self.fid_values
+        pos = np.clip(np.searchsorted(values, fids),
+            0, len(values) - 1)
+        return np.where(values[pos] == fids, pos,
+            -1).astype(np.int32)
+
+    def get_cc_codes(self, ccs):
+        # -1 for '' or unknown country codes
+        ccs = np.asarray(ccs, dtype=str)
+        values = self.cc_values
+        pos = np.clip(np.searchsorted(values, ccs),
+            0, len(values) - 1)
+        return np.where(values[pos] == ccs, pos,
+            -1).astype(np.int32)
+
+    def get_polygon(self, fid_code):
+        offsets = self.arrays['poly_offsets']
+        rows = self.arrays['poly_order'][
+            offsets[fid_code]:offsets[fid_code + 1]]
+        return self.points[rows]
+
+    def get_polygon_cc(self, fid_code):
+        return self.cc_values[
+            self.arrays['poly_cc_codes'][fid_code]]
+
+    def query_bbox(self, lat, lon):
+        """
+        Returns (point index, fid code) pairs for every
+        polygon whose bounding box holds the point.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        row, col = self.get_grid_cell(lat, lon)
+        cell = row * self.get_grid_shape()[1] + col
+        grid_offsets = self.arrays['grid_offsets']
+        start = grid_offsets[cell]
+        count = grid_offsets[cell + 1] - start
+        point_idx = np.repeat(
+            np.arange(len(lat)), count)
+        # position of every pair inside its grid cell
+        within = np.arange(count.sum()) - np.repeat(
+            np.cumsum(count) - count, count)
+        fid_codes = self.arrays['grid_polys'][
+            np.repeat(start, count) + within]
+        bbox = self.arrays['poly_bbox'][fid_codes]
+        plat = lat[point_idx]
+        plon = lon[point_idx]
+        keep = (bbox[:, 0] <= plat) & (
+            plat <= bbox[:, 2]) & (
+            bbox[:, 1] <= plon) & (plon <= bbox[:, 3])
+        return point_idx[keep], fid_codes[keep]
+
+    def to_frame(self):
+        return pd.DataFrame({
+            'lat': np.array(self.points[:, 0]),
+            'lon': np.array(self.points[:, 1]),
+            'country_code': self.cc_values[
+                self.cc_codes].astype(object),
+            'fid': self.fid_values[self.fid_codes]})
+
+
+class InteriorGrid(CompiledArrays):
+    """
+    Global raster of cell_deg cells over the boundary
+    polygons. A cell holds the fid code of the polygon
+    it lies entirely inside, WATER when it is inside
+    none or MIXED when a polygon edge passes through
+    it or a neighbouring cell. Points in interior cells
+    are resolved with an array lookup.
+    """
+    version = 1
+    suffix = '.grid'
+    MIXED = -1
+    WATER = -2
+
+    def __init__(self, fname_source, cell_deg=0.1,
+        rebuild=False):
+        self.cell_deg = float(cell_deg)
+        self.BI = BoundaryIndex.load_cached(fname_source)
+        super().__init__(fname_source, rebuild=rebuild)
+
+    def get_params(self):
+        return {'cell_deg': self.cell_deg}
+
+    def get_shape(self):
+        return (int(np.ceil(180 / self.cell_deg)),
+            int(np.ceil(360 / self.cell_deg)))
+
+    def get_cells(self, lat, lon):
+        num_rows, num_cols = self.get_shape()
+        row = np.clip(np.floor(
+            (np.asarray(lat) + 90) / self.cell_deg
+            ).astype(np.int64), 0, num_rows - 1)
+        col = np.clip(np.floor(
+            (np.asarray(lon) + 180) / self.cell_deg
+            ).astype(np.int64), 0, num_cols - 1)
+        return row * num_cols + col
+
+    def compile(self):
+        num_rows, num_cols = self.get_shape()
+        mixed = self.get_edge_cells().reshape(
+            num_rows, num_cols)
+        # One cell margin, so interior points are never
+        # close to an edge
+        margin = mixed.copy()
+        margin[1:] |= mixed[:-1]
+        margin[:-1] |= mixed[1:]
+        mixed = margin.copy()
+        mixed[:, 1:] |= margin[:, :-1]
+        mixed[:, :-1] |= margin[:, 1:]
+        mixed = mixed.ravel()
+        # No edge passes between two neighbouring clear
+        # cells of a row, so one center per run of clear
+        # cells decides the whole run
+        clear = np.flatnonzero(~mixed)
+        run_start = np.ones(len(clear), dtype=np.bool_)
+        run_start[1:] = (np.diff(clear) != 1) | (
+            clear[1:] % num_cols == 0)
+        run_id = np.cumsum(run_start) - 1
+        starts = clear[run_start]
+        lat = (starts // num_cols + 0.5
+            ) * self.cell_deg - 90
+        lon = (starts % num_cols + 0.5
+            ) * self.cell_deg - 180
+        point_idx, fid_codes = self.BI.query_bbox(
+            lat, lon)
+        inside = PointInPolygon().run(lat, lon,
+            point_idx, fid_codes, self.BI.get_polygon)
+        count = np.bincount(point_idx[inside],
+            minlength=len(starts))
+        value = np.full(len(starts), self.WATER,
+            dtype=np.int32)
+        value[count > 1] = self.MIXED
+        one = count[point_idx[inside]] == 1
+        value[point_idx[inside][one]] = fid_codes[
+            inside][one]
+        cells = np.full(num_rows * num_cols, self.MIXED,
+            dtype=np.int32)
+        cells[clear] = value[run_id]
+        if len(self.BI.fid_values) < np.iinfo(
+            np.int16).max:
+            cells = cells.astype(np.int16)
+        return {'cells': cells,
+            # water, mixed and interior cell counts
+            'counts': np.bincount(np.clip(
+                cells, -2, 0) + 2, minlength=3)}
+
+    def get_edge_cells(self):
+        # Marks every cell a polygon edge passes
+        # through. Edges are cut into pieces no longer
+        # than a cell, so a piece touches at most the
+        # 2x2 cells of its bounding box
+        a, b = self.BI.get_edge_pieces(self.cell_deg)
+        low = np.minimum(a, b)
+        high = np.maximum(a, b)
+        num_rows, num_cols = self.get_shape()
+        edge_cells = np.zeros(num_rows * num_cols,
+            dtype=np.bool_)
+        for lat in (low[:, 0], high[:, 0]):
+            for lon in (low[:, 1], high[:, 1]):
+                edge_cells[self.get_cells(lat, lon)] = True
+        return edge_cells
+
+    def get_stats(self):
+        cells = self.arrays['cells']
+        stats = self.arrays['counts'] / max(
+            len(cells), 1)
+        return (f'Interior grid {self.get_shape()} '
+            f'cells of {self.cell_deg} deg: '
+            f'{round(cells.nbytes / 1e6, 1)} MB, '
+            f'{round(100 * stats[2], 1)}% interior, '
+            f'{round(100 * stats[1], 1)}% mixed, '
+            f'{round(100 * stats[0], 1)}% water')
+
+    def lookup(self, lat, lon):
+        """
+        Returns the fid code of every point, or MIXED /
+        WATER when the point needs the exact path.
+        """
+        return self.arrays['cells'][
+            self.get_cells(lat, lon)].astype(np.int32)
+
+
+class CityIndex:
+    """
+    One KDTree per country over the compiled cities500
+    table, built the first time the country is queried
+    and kept for the life of the process.
+    """
+    _cache = {}
+
+    def __init__(self, city_table):
+        self.CT = city_table
+        self.trees = {}
+
+    @classmethod
+    def load_cached(cls, fname):
+        # Trees are kept as long as the compiled table
+        # is still current
+        city_table = CityTable.load_cached(fname)
+        key = str(Path(fname).resolve())
+        if key not in cls._cache or \
+            cls._cache[key].CT is not city_table:
+            cls._cache[key] = cls(city_table)
+        return cls._cache[key]
+
+    def get_tree(self, cc):
+        if cc not in self.trees:
+            rows = self.CT.get_rows(cc)
+            if rows.stop == rows.start:
+                self.trees[cc] = None
+            else:
+                self.trees[cc] = KDTree(np.column_stack([
+                    self.CT.arrays['lat'][rows],
+                    self.CT.arrays['lon'][rows]]),
+                    leafsize=30)
+        return self.trees[cc]
+
+    def query(self, cc, lat, lon, workers=-1):
+        """
+        Returns the admin1 and name arrays of the
+        closest city in country cc for every point.
+        """
+        tree = self.get_tree(cc)
+        if tree is None:
+            empty = np.full(len(lat), '', dtype=object)
+            return empty, empty.copy()
+        _, ii = tree.query(np.column_stack(
+            [lat, lon]), k=1, workers=workers)
+        rows = self.CT.get_rows(cc).start + ii
+        return (self.CT.get_column('admin1', rows),
+            self.CT.get_column('name', rows))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3.11
+from collections import OrderedDict
+import os
+from pathlib import Path
+import pickle
+
+import numpy as np
+
+
+class GeocodeCache:
+    """
+    LRU cache of resolved (fid, country_code,
+    admin_name, city) keyed by a fixed degree grid
+    cell. Cells close to a border are stored as None
+    so their points always take the exact path.
+    """
+    def __init__(self, cell_deg=0.001, max_cells=500000,
+        fname='', version=''):
+        self.cell_deg = cell_deg
+        self.max_cells = max_cells
+        self.fname = fname
+        self.version = version
+        self.cells = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.border = 0
+        if self.fname:
+            self.load()
+
+    def get_keys(self, lat, lon):
+        row = np.floor((np.asarray(lat) + 90
+            ) / self.cell_deg).astype(np.int64)
+        col = np.floor((np.asarray(lon) + 180
+            ) / self.cell_deg).astype(np.int64)
+        return row * int(round(360 / self.cell_deg) + 1
+            ) + col
+
+    def lookup(self, lat, lon):
+        """
+        Returns a hit mask and the cached values as
+        (fid, country_code, admin_name, city) arrays
+        for the hits.
+        """
+        keys = self.get_keys(lat, lon)
+        hit = np.zeros(len(keys), dtype=np.bool_)
+        values = []
+        for idx, key in enumerate(keys.tolist()):
+            value = self.cells.get(key, False)
+            if value is False:
+                self.misses += 1
+            elif value is None:
+                self.border += 1
+            else:
+                self.cells.move_to_end(key)
+                self.hits += 1
+                hit[idx] = True
+                values.append(value)
+        if values:
+            fid, cc, admin_name, city = zip(*values)
+        else:
+            fid = cc = admin_name = city = ()
+        return hit, (np.array(fid, dtype=np.float64),
+            np.array(cc, dtype=object),
+            np.array(admin_name, dtype=object),
+            np.array(city, dtype=object))
+
+    def mark_border(self, lat, lon):
+        for key in self.get_keys(lat, lon).tolist():
+            self.cells[key] = None
+            self.cells.move_to_end(key)
+        self.evict()
+
+    def update(self, lat, lon, fid, cc, admin_name,
+        city):
+        for key, value in zip(
+            self.get_keys(lat, lon).tolist(),
+            zip(fid, cc, admin_name, city)):
+            if key in self.cells:
+                # Keep border flags and first answers
+                continue
+            self.cells[key] = value
+        self.evict()
+
+    def evict(self):
+        while len(self.cells) > self.max_cells:
+            self.cells.popitem(last=False)
+
+    def get_stats(self):
+        total = self.hits + self.misses + self.border
+        ratio = round(100 * self.hits / total, 1
+            ) if total else 0
+        return (f'Geocode cache: {self.hits} hits, '
+            f'{self.misses} misses, {self.border} '
+            f'border points, {ratio}% hit rate, '
+            f'{len(self.cells)} cells')
+
+    def load(self):
+        try:
+            with open(self.fname, 'rb') as f:
+                data = pickle.load(f)
+        except (FileNotFoundError, EOFError,
+            pickle.UnpicklingError):
+            return
+        if data.get('version') != self.version or \
+            data.get('cell_deg') != self.cell_deg:
+            print('Geocode cache is out of date. '
+                'Starting a new one.')
+            return
+        self.cells = data['cells']
+        self.evict()
+
+    def save(self):
+        if not self.fname:
+            return
+        Path(self.fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{self.fname}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': self.version,
+                'cell_deg': self.cell_deg,
+                'cells': self.cells}, f,
+                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.fname)
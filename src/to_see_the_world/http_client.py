@@ -0,0 +1,212 @@
+#!/usr/bin/env python3.11
+import hashlib
+import os
+from pathlib import Path
+import pickle
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+
+class HttpClient:
+    """
+    One pooled requests.Session (keep-alive) for every
+    call to a host. Failed connections, and the read
+    errors and retry_statuses answers of idempotent
+    methods (not POST), are retried with exponential
+    backoff, honouring Retry-After.
+    With cache_folder set, 200 answers are kept on
+    disk. Answers with an ETag or Last-Modified header
+    are revalidated with If-None-Match /
+    If-Modified-Since, and a 304 returns the stored
+    body. Answers without either are reused for
+    max_age seconds. The least recently used answers
+    are dropped once the folder holds more than
+    max_cache_mb.
+    """
+    instances = {}
+    prune_every = 100
+
+    def __init__(self, retries=4, backoff=0.5,
+        pool_size=10, cache_folder='', max_age=0,
+        retry_statuses=(429, 500, 502, 503, 504),
+        max_cache_mb=200):
+        self.cache_folder = cache_folder
+        self.max_age = max_age
+        self.max_cache_mb = max_cache_mb
+        self.saves = 0
+        self.session = requests.Session()
+        retry = Retry(total=retries,
+            backoff_factor=backoff,
+            status_forcelist=retry_statuses,
+            respect_retry_after_header=True,
+            raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if self.cache_folder:
+            self.prune()
+
+    @classmethod
+    def from_config(cls, config, pwd, **kwargs):
+        """
+        Shared client for the [http] config section.
+        kwargs override the config values.
+        """
+        params = {
+            'retries': config.getint('http', 'retries'),
+            'backoff': config.getfloat(
+                'http', 'backoff'),
+            'pool_size': config.getint(
+                'http', 'pool_size'),
+            'cache_folder': '',
+            'max_age': config.getint('http', 'max_age'),
+            'max_cache_mb': config.getint('http',
+                'max_cache_mb', fallback=200)}
+        if config.getboolean('http', 'cache'):
+            params['cache_folder'] = (f'{pwd}/'
+                f'{config.get("path", "http_cache_folder")}')
+        params.update(kwargs)
+        key = tuple(sorted(params.items()))
+        if key not in cls.instances:
+            cls.instances[key] = cls(**params)
+        return cls.instances[key]
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, params=None,
+        data=None, headers=None, timeout=60,
+        cache_key=None):
+        """
+        cache_key: owner of the answer (a Strava
+        athlete id) in the cache key. Without it the
+        Authorization header is used.
+        """
+        if not self.cache_folder:
+            return self.session.request(method, url,
+                params=params, data=data,
+                headers=headers, timeout=timeout)
+        fname = self.get_cache_fname(
+            method, url, params, data, headers,
+            cache_key)
+        entry = self.load(fname)
+        validators = {}
+        if entry:
+            stored = CaseInsensitiveDict(
+                entry['headers'])
+            if 'ETag' in stored:
+                validators['If-None-Match'] = \
+                    stored['ETag']
+            if 'Last-Modified' in stored:
+                validators['If-Modified-Since'] = \
+                    stored['Last-Modified']
+            if not validators and time.time() - \
+                entry['time'] < self.max_age:
+                return self.get_response(entry)
+        r = self.session.request(method, url,
+            params=params, data=data,
+            headers=dict(headers or {}, **validators),
+            timeout=timeout)
+        if r.status_code == 304 and entry:
+            # Headers of a 304 update the stored ones
+            entry['headers'].update(r.headers)
+            entry['time'] = time.time()
+            self.save(fname, entry)
+            return self.get_response(entry)
+        if r.status_code == 200:
+            self.save(fname, {'url': r.url,
+                'headers': dict(r.headers),
+                'content': r.content,
+                'time': time.time()})
+        return r
+
+    def get_cache_fname(self, method, url, params,
+        data, headers, cache_key=None):
+        # The owner is part of the key, answers of one
+        # athlete are never shared. A refreshed token
+        # keeps the answers of its athlete
+        if cache_key is None:
+            cache_key = (headers or {}).get(
+                'Authorization')
+        key = repr((method, url,
+            sorted((params or {}).items()),
+            sorted(data.items()) if isinstance(
+            data, dict) else data,
+            str(cache_key)))
+        return (f'{self.cache_folder}/'
+            f'{hashlib.sha1(key.encode()).hexdigest()}'
+            '.pickle')
+
+    def get_response(self, entry):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = entry['url']
+        r.headers = CaseInsensitiveDict(
+            entry['headers'])
+        r._content = entry['content']
+        r.from_cache = True
+        return r
+
+    def load(self, fname):
+        try:
+            with open(fname, 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError,
+            pickle.UnpicklingError):
+            return None
+        # The modification time marks the last use
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def save(self, fname, entry):
+        Path(fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{fname}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(entry, f,
+                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fname)
+        self.saves += 1
+        if self.saves % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        # Removes the least recently used answers until
+        # the folder is below max_cache_mb
+        try:
+            entries = [e for e in os.scandir(
+                self.cache_folder)
+                if e.name.endswith('.pickle')]
+        except FileNotFoundError:
+            return
+        files = []
+        for e in entries:
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size,
+                e.path))
+        total = sum(size for _, size, _ in files)
+        limit = self.max_cache_mb * 1e6
+        for _, size, path in sorted(files):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
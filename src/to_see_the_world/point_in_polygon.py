@@ -0,0 +1,95 @@
+#!/usr/bin/env python3.11
+import numpy as np
+
+
+class PointInPolygon:
+    """
+    Batched ray casting point in polygon tests. Work
+    is given as (point, polygon) pairs and edges are
+    processed in vectorized blocks. A block never holds
+    more than max_scratch point/edge values.
+    """
+    def __init__(self, max_scratch=1 << 20):
+        self.max_scratch = max_scratch
+
+    def run(self, x, y, point_idx, poly_idx,
+        get_polygon):
+        """
+        Args:
+            x, y (arrays): point coordinates. x is
+            compared against polygon column 0 and y
+            against column 1.
+            point_idx, poly_idx (arrays): pairs to test
+            get_polygon (callable): poly id -> (m, 2)
+            array of vertices
+        Returns:
+            inside (bool array): one flag per pair
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        point_idx = np.asarray(point_idx, dtype=np.int64)
+        poly_idx = np.asarray(poly_idx, dtype=np.int64)
+        inside = np.zeros(len(point_idx), dtype=np.bool_)
+        if len(point_idx) == 0:
+            return inside
+        order = np.argsort(poly_idx, kind='stable')
+        polys, starts = np.unique(
+            poly_idx[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for poly, start, end in zip(polys, starts, ends):
+            pairs = order[start:end]
+            pts = point_idx[pairs]
+            inside[pairs] = self.run_polygon(
+                x[pts], y[pts], get_polygon(poly))
+        return inside
+
+    def run_polygon(self, x, y, poly):
+        poly = np.asarray(poly, dtype=np.float64)
+        inside = np.zeros(len(x), dtype=np.bool_)
+        if len(x) == 0 or len(poly) == 0:
+            return inside
+        # bbox prefilter
+        cand = np.flatnonzero(
+            (x >= poly[:, 0].min()) & (
+            x <= poly[:, 0].max()) & (
+            y >= poly[:, 1].min()) & (
+            y <= poly[:, 1].max()))
+        if len(cand) == 0:
+            return inside
+        p1x = poly[:, 0]
+        p1y = poly[:, 1]
+        p2x = np.roll(p1x, -1)
+        p2y = np.roll(p1y, -1)
+        for c0 in range(0, len(cand), self.max_scratch):
+            sub = cand[c0:c0 + self.max_scratch]
+            xs = x[sub]
+            ys = y[sub]
+            # Only edges spanning the y range of these
+            # points can be crossed
+            edges = np.flatnonzero(
+                (np.maximum(p1y, p2y) > ys.min()) & (
+                np.minimum(p1y, p2y) <= ys.max()))
+            step = max(1, self.max_scratch // len(sub))
+            parity = np.zeros(len(sub), dtype=np.bool_)
+            for e0 in range(0, len(edges), step):
+                e = edges[e0:e0 + step]
+                parity ^= self.count_crossings(
+                    xs, ys, p1x[e], p1y[e],
+                    p2x[e], p2y[e]) % 2 == 1
+            inside[sub] = parity
+        return inside
+
+    def count_crossings(self, x, y, p1x, p1y, p2x, p2y):
+        # Same rules as the scalar ray casting loop: an
+        # edge counts when it straddles the point's y
+        # and crosses to the right of the point's x
+        x = x[:, None]
+        y = y[:, None]
+        straddle = ((p1y <= y) & (p2y > y)) | (
+            (p2y <= y) & (p1y > y))
+        den = p2y - p1y
+        den = np.where(den == 0, 1.0, den)
+        intersect_x = (p2x - p1x) * (
+            y - p1y) / den + p1x
+        return np.count_nonzero(
+            straddle & (x < intersect_x), axis=1)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3.11
+from email.utils import parsedate_to_datetime
+import heapq
+import itertools
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+from stravalib.util.limiter import (
+    get_rates_from_response_headers)
+
+
+class RateScheduler:
+    """
+    Token buckets for one API, shared by every thread
+    of the process and kept on disk across runs. Each
+    bucket holds limit tokens per window of seconds
+    (windows aligned to utc, like the Strava quarter
+    hours and days) and is refilled at the start of the
+    next window. Buckets named in rolling count the
+    tokens taken in the last seconds instead, so no
+    two requests of a one per second budget are closer
+    than a second. acquire() takes one token of every
+    bucket. Waiting requests are served by priority
+    (NEW before BACKFILL) and then in arrival order.
+    When a bucket is empty the work is suspended until
+    its window ends, it never fails.
+    X-RateLimit-Usage / X-RateLimit-Limit headers
+    update the buckets named in header_buckets. A 429
+    answer suspends the work for its Retry-After, or
+    else empties the first bucket. Longer buckets are
+    only emptied by the usage headers, so a transient
+    429 never waits for the next day. The pace
+    spreads requests like stravalib's
+    SleepingRateLimitRule: 'high' has no cool-down,
+    'medium' spreads the first bucket and 'low' the
+    last one.
+    """
+    NEW = 0
+    BACKFILL = 1
+    instances = {}
+
+    def __init__(self, name, buckets, fname='',
+        pace='high', header_buckets=(), rolling=()):
+        if pace not in ['low', 'medium', 'high']:
+            raise ValueError(
+                f'Invalid pace "{pace}", expecting one '
+                'of "low", "medium" or "high"')
+        self.name = name
+        self.fname = fname
+        self.pace = pace
+        self.header_buckets = list(header_buckets)
+        # name -> {'limit', 'seconds', 'window', 'used',
+        # 'times'}. times of the tokens taken, rolling
+        # buckets only
+        self.buckets = {b: {'limit': limit,
+            'seconds': seconds, 'window': -1, 'used': 0,
+            'times': [] if b in rolling else None}
+            for b, (limit, seconds) in buckets.items()}
+        self.queue = []
+        self.counter = itertools.count()
+        self.next_start = 0
+        # time.time() until which a Retry-After holds
+        # every request
+        self.retry_at = 0
+        self.lock = threading.Condition()
+        if self.fname:
+            self.load()
+
+    @classmethod
+    def from_config(cls, config, pwd, name):
+        """
+        Shared scheduler of an API ('strava' or 'otd')
+        set up from the [rate_budget] config section.
+        """
+        key = (str(pwd), name)
+        if key not in cls.instances:
+            c = config['rate_budget']
+            if name == 'strava':
+                buckets = {
+                    'short': (int(c['strava_short_limit']),
+                        900),
+                    'long': (int(c['strava_long_limit']),
+                        86400)}
+                header_buckets = ['short', 'long']
+                rolling = []
+            else:
+                buckets = {
+                    'second': (int(c['otd_second_limit']),
+                        1),
+                    'day': (int(c['otd_day_limit']),
+                        86400)}
+                header_buckets = []
+                rolling = ['second']
+            fname_rate_budget = config.get(
+                'path', 'fname_rate_budget')
+            cls.instances[key] = cls(name, buckets,
+                fname=f'{pwd}/{fname_rate_budget}',
+                pace=c[f'{name}_pace'],
+                header_buckets=header_buckets,
+                rolling=rolling)
+        return cls.instances[key]
+
+    def acquire(self, priority=NEW):
+        with self.lock:
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.queue, ticket)
+            suspended = False
+            while True:
+                wait = None
+                if self.queue[0] == ticket:
+                    wait = self.get_wait_time()
+                    if wait <= 0:
+                        break
+                    if wait > 1 and not suspended:
+                        print(f'{self.name} rate budget '
+                            'used up. Suspending for '
+                            f'{wait:.0f} seconds')
+                        suspended = True
+                self.lock.wait(wait)
+            heapq.heappop(self.queue)
+            for bucket in self.buckets.values():
+                bucket['used'] += 1
+                if bucket['times'] is not None:
+                    bucket['times'].append(time.time())
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + \
+                self.get_cool_down()
+            self.lock.notify_all()
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, headers=None, limited=False):
+        with self.lock:
+            self.roll_windows()
+            rates = get_rates_from_response_headers(
+                headers or {})
+            if rates and self.header_buckets:
+                # Responses arrive out of order, the
+                # highest usage is the latest
+                for b, used, limit in zip(
+                    self.header_buckets,
+                    [rates.short_usage, rates.long_usage],
+                    [rates.short_limit, rates.long_limit]):
+                    bucket = self.buckets[b]
+                    bucket['used'] = max(
+                        bucket['used'], used)
+                    bucket['limit'] = limit
+            retry_after = self.get_retry_after(headers)
+            if limited and retry_after is not None:
+                self.retry_at = max(self.retry_at,
+                    time.time() + retry_after)
+            elif limited and self.get_wait_time() <= 0:
+                bucket = next(iter(
+                    self.buckets.values()))
+                bucket['used'] = max(bucket['used'],
+                    bucket['limit'])
+                if bucket['times'] is not None:
+                    bucket['times'] = [time.time()] * \
+                        bucket['limit']
+            if self.fname:
+                self.save()
+            self.lock.notify_all()
+
+    def get_retry_after(self, headers):
+        # Seconds or an http date, None if missing
+        value = (headers or {}).get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(
+                value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def get_window(self, bucket):
+        return int(time.time() // bucket['seconds'])
+
+    def roll_windows(self):
+        now = time.time()
+        for bucket in self.buckets.values():
+            window = self.get_window(bucket)
+            if bucket['times'] is not None:
+                bucket['times'] = [t for t in
+                    bucket['times']
+                    if t > now - bucket['seconds']]
+                bucket['used'] = len(bucket['times'])
+            elif window != bucket['window']:
+                bucket['used'] = 0
+            bucket['window'] = window
+
+    def get_seconds_left(self, bucket):
+        if bucket['times'] is not None:
+            # Until the oldest token counted is freed
+            return (bucket['times'][0] if
+                bucket['times'] else time.time()) + \
+                bucket['seconds'] - time.time()
+        return (bucket['window'] + 1) * \
+            bucket['seconds'] - time.time()
+
+    def get_wait_time(self):
+        self.roll_windows()
+        return max([self.get_seconds_left(bucket)
+            for bucket in self.buckets.values()
+            if bucket['used'] >= bucket['limit']] +
+            [max(self.retry_at - time.time(), 0)])
+
+    def get_cool_down(self):
+        if self.pace == 'high':
+            return 0
+        buckets = list(self.buckets.values())
+        bucket = buckets[0] if self.pace == 'medium' \
+            else buckets[-1]
+        return self.get_seconds_left(bucket) / max(
+            bucket['limit'] - bucket['used'], 1)
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                saved = json.load(f).get(self.name, {})
+        except (FileNotFoundError,
+            json.JSONDecodeError):
+            return
+        for b, bucket in self.buckets.items():
+            if b in saved and saved[b]['window'] == \
+                self.get_window(bucket) and \
+                bucket['times'] is None:
+                bucket.update(window=saved[b]['window'],
+                    used=saved[b]['used'])
+                if b in self.header_buckets:
+                    bucket['limit'] = saved[b]['limit']
+
+    def save(self):
+        # Other runs may share the file, every API
+        # keeps the highest usage of the window
+        try:
+            with open(self.fname) as f:
+                data = json.load(f)
+        except (FileNotFoundError,
+            json.JSONDecodeError):
+            data = {}
+        saved = data.get(self.name, {})
+        for b, bucket in self.buckets.items():
+            if b in saved and saved[b]['window'] == \
+                bucket['window'] and \
+                bucket['times'] is None:
+                bucket['used'] = max(bucket['used'],
+                    saved[b]['used'])
+        data[self.name] = {b: {k: bucket[k] for k in
+            ['window', 'used', 'limit']}
+            for b, bucket in self.buckets.items()}
+        Path(self.fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{self.fname}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.fname)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3.11
+from concurrent.futures import ThreadPoolExecutor
+
+from http_client import HttpClient
+from rate_scheduler import RateScheduler
+
+
+class StravaFetcher:
+    """
+    Strava API requests through one RateScheduler.
+    get_pages fetches the pages of a list endpoint on a
+    thread pool and yields them in page order. The
+    number of pages requested ahead of the one being
+    read starts at one and doubles with every full
+    page up to prefetch, so an incremental sync that
+    stops on the first page costs a single request.
+    Pages still pending when the reader stops are
+    cancelled. Fetchers of several athletes share one
+    scheduler, Strava's quotas are per application.
+    priority orders their requests when the budget
+    is short (RateScheduler.NEW before BACKFILL).
+    headers is a dict or a function called before
+    every request, so a download suspended by the
+    scheduler for hours sends a refreshed token.
+    """
+    def __init__(self, headers,
+        base_url='https://www.strava.com/api/v3',
+        workers=4, prefetch=4,
+        priority=RateScheduler.NEW, timeout=180,
+        max_retries=3, http=None, scheduler=None,
+        cache_key=None):
+        self.headers = headers
+        # Athlete of the answers in the http cache
+        self.cache_key = cache_key
+        # 429 answers are left to the scheduler
+        self.http = http or HttpClient(
+            retry_statuses=(500, 502, 503, 504))
+        self.base_url = base_url.rstrip('/')
+        self.workers = max(workers, 1)
+        self.prefetch = max(prefetch, 1)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.priority = priority
+        self.scheduler = scheduler or RateScheduler(
+            'strava', {'short': (200, 900),
+            'long': (2000, 86400)},
+            header_buckets=['short', 'long'])
+
+    def get_headers(self):
+        if callable(self.headers):
+            return self.headers()
+        return self.headers
+
+    def get(self, path, params=None, priority=None):
+        if priority is None:
+            priority = self.priority
+        url = f'{self.base_url}/{path.lstrip("/")}'
+        for retry in range(self.max_retries + 1):
+            self.scheduler.acquire(priority)
+            headers = None
+            try:
+                r = self.http.get(url,
+                    headers=self.get_headers(),
+                    params=params,
+                    timeout=self.timeout,
+                    cache_key=self.cache_key)
+                headers = r.headers
+            finally:
+                self.scheduler.release(headers,
+                    limited=headers is not None and \
+                    r.status_code == 429)
+            if r.status_code != 429:
+                # An error answer (401, 404, ...) is not
+                # the end of the data
+                if not r.ok:
+                    print(f'Issue. Response json: '
+                        f'{r.text}')
+                r.raise_for_status()
+                return r.json()
+            print(f'Strava rate limit hit (429) for '
+                f'{path}. Retry {retry + 1}')
+        # An interrupted download must not look like
+        # the end of the data
+        r.raise_for_status()
+
+    def get_pages(self, path, params=None,
+        per_page=200, page_count=200, priority=None):
+        """
+        Yields (page, response) for pages 1 to
+        page_count - 1 of a list endpoint. Stops after
+        the first page with fewer than per_page items.
+        Stop early by breaking out of the loop.
+        """
+        params = dict(params or {}, per_page=per_page)
+        pool = ThreadPoolExecutor(self.workers)
+        pending = {}
+        ahead = 1
+        next_page = 1
+        try:
+            for page in range(1, page_count):
+                while next_page < min(
+                    page + ahead, page_count):
+                    pending[next_page] = pool.submit(
+                        self.get, path,
+                        dict(params, page=next_page),
+                        priority)
+                    next_page += 1
+                response = pending.pop(page).result()
+                yield page, response
+                if not isinstance(response, list) or \
+                    len(response) < per_page:
+                    break
+                ahead = min(ahead * 2, self.prefetch)
+        finally:
+            for future in pending.values():
+                future.cancel()
+            pool.shutdown(wait=False)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3.11
+import json
+import os
+from pathlib import Path
+
+
+class SyncState:
+    """
+    Where the next Strava sync of one athlete starts:
+    the newest start_date_local stored, the ids of the
+    activities at that time and the schema version of
+    the stored data. Kept as a small json file per
+    athlete and replaced atomically after every save of
+    the athlete's data.
+    """
+    version = 1
+
+    def __init__(self, folder, a_id, schema_version=''):
+        self.fname = f'{folder}/sync_{a_id}.json'
+        self.schema_version = \
+            f'{self.version}:{schema_version}'
+        self.last_time = ''
+        self.last_ids = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                data = json.load(f)
+        except (FileNotFoundError,
+            json.JSONDecodeError):
+            return
+        if data.get('schema_version') != \
+            self.schema_version:
+            print('Sync state is out of date. '
+                'Starting a new one.')
+            return
+        self.last_time = data['last_time']
+        self.last_ids = data['last_ids']
+
+    def update(self, df):
+        # df: saved activities of the athlete.
+        # start_date_local strings sort by time
+        times = df.start_date_local.dropna()
+        if len(times) == 0 or \
+            times.max() < self.last_time:
+            return
+        ids = [int(x) for x in df.id[
+            df.start_date_local == times.max()]]
+        if times.max() == self.last_time:
+            ids = sorted(set(self.last_ids + ids))
+        self.last_time = times.max()
+        self.last_ids = ids
+
+    def save(self):
+        Path(self.fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{self.fname}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'schema_version': self.schema_version,
+                'last_time': self.last_time,
+                'last_ids': self.last_ids}, f)
+        os.replace(tmp, self.fname)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3.11
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+from time import time
+from urllib.parse import parse_qs, urlparse
+
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import polyline
+
+from test_strava_fetcher import StandInStrava
+from to_see_the_world import StravaData
+
+
+class StandInStravaAthletes(StandInStrava):
+    """
+    StandInStrava with one activity list per athlete.
+    Access tokens look like access-<athlete id>-<n>,
+    refresh tokens refresh-<athlete id>, and
+    POST /oauth/token hands out a new access token.
+    Tokens in expired are answered with 401, and the
+    activity page of an athlete in failed_pages with
+    503.
+    """
+    latency = 0.05
+    athletes = {}
+    refreshed = []
+    expired = set()
+    failed_pages = {}
+
+    def get_a_id(self):
+        token = self.headers.get(
+            'Authorization', '').split('-')
+        if len(token) != 3 or \
+            token[0] != 'Bearer access' or \
+            int(token[1]) not in self.athletes or \
+            self.headers['Authorization'] in \
+            self.expired:
+            return None
+        return int(token[1])
+
+    def do_GET(self):
+        a_id = self.get_a_id()
+        if a_id is None:
+            return self.send(401, {'message':
+                'Authorization Error'}, 0)
+        self.a_id = a_id
+        self.num_activities = self.athletes[a_id]
+        query = parse_qs(urlparse(self.path).query)
+        if self.failed_pages.get(a_id) == int(
+            query.get('page', ['1'])[0]):
+            return self.send(503, {'message':
+                'Service Unavailable'}, 0)
+        return super().do_GET()
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(
+            self.headers['Content-Length'])).decode())
+        token = body['refresh_token'][0]
+        a_id = int(token.split('-')[1])
+        type(self).refreshed.append(a_id)
+        self.send(200, {'access_token':
+            f'access-{a_id}-{len(self.refreshed)}',
+            'refresh_token': token,
+            'expires_at': int(time()) + 21600}, 0)
+
+    def get_activity(self, i):
+        d = super().get_activity(i)
+        d['id'] = self.a_id * 100000 + i
+        d['athlete'] = {'id': self.a_id}
+        d['type'] = 'Ride'
+        d['distance'] = 1000.0 + i
+        lat = 46.5 + (i % 20) * 0.05
+        lon = 7.0 + (self.a_id % 5) * 0.2
+        # Syncs geocode every 4th point
+        d['map'] = {'summary_polyline': polyline.encode(
+            [(lat + k * 0.005, lon + k * 0.005)
+            for k in range(8)])}
+        return d
+
+
+class TestAthleteSync():
+    def __init__(self):
+        StandInStravaAthletes.athletes = {
+            11: 1000, 22: 600, 33: 250}
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), StandInStravaAthletes)
+        threading.Thread(
+            target=self.server.serve_forever,
+            daemon=True).start()
+        self.url = ('http://127.0.0.1:'
+            f'{self.server.server_address[1]}')
+        self.pwd = Path.cwd()
+
+    def write_supporting_data(self, folder):
+        # Two countries split at lon 7.5, athletes 11
+        # and 22 ride in CH and 33 in IT. The boundary
+        # and cities csvs are downloads not kept in the
+        # repo
+        Path(f'{folder}/supporting_data').mkdir()
+        shutil.copy(
+            self.pwd / 'supporting_data/country_data.csv',
+            f'{folder}/supporting_data')
+        rows = []
+        for fid, cc, lon0 in [(1, 'CH', 6.0),
+            (2, 'IT', 7.5)]:
+            steps = np.arange(0, 1.5, 0.01)
+            lat = np.concatenate([46 + steps * 4 / 3,
+                np.full(len(steps), 48.0),
+                48 - steps * 4 / 3,
+                np.full(len(steps), 46.0)])
+            lon = np.concatenate([np.full(len(steps),
+                lon0), lon0 + steps,
+                np.full(len(steps), lon0 + 1.5),
+                lon0 + 1.5 - steps])
+            rows.append(pd.DataFrame({'lat': lat,
+                'lon': lon, 'country_code': cc,
+                'fid': float(fid)}))
+        pd.concat(rows).to_csv(f'{folder}/supporting_data/'
+            'country_boundaries_shifted.csv', index=False)
+        pd.DataFrame({'lat': [46.8, 47.2, 46.8, 47.2],
+            'lon': [7.0, 7.2, 8.0, 8.2],
+            'name': ['Bern', 'Solothurn', 'Aosta',
+            'Biella'], 'admin1': ['BE', 'SO', 'VDA',
+            'PIE'], 'cc': ['CH', 'CH', 'IT', 'IT']}
+            ).to_csv(f'{folder}/supporting_data/'
+            'cities500.csv', index=False)
+
+    def setup_folder(self, folder, sync_workers):
+        # A folder of its own, the athlete data of the
+        # real config is not touched
+        config = open(self.pwd / 'config.ini').read()
+        config = config.replace(
+            'https://www.strava.com/api/v3', self.url
+            ).replace('https://www.strava.com/oauth',
+            f'{self.url}/oauth').replace(
+            'sync_workers = 4',
+            f'sync_workers = {sync_workers}').replace(
+            'retries = 4', 'retries = 0')
+        with open(f'{folder}/config.ini', 'w') as f:
+            f.write(config)
+        with open(f'{folder}/secrets.ini', 'w') as f:
+            f.write('[strava]\nSTRAVA_CLIENT_ID = 1\n'
+                'STRAVA_CLIENT_SECRET = test\n')
+        self.write_supporting_data(folder)
+        # The token of 33 has expired
+        tokens = {str(a_id): {
+            'access_token': f'access-{a_id}-0',
+            'refresh_token': f'refresh-{a_id}',
+            'expires_at': 0 if a_id == 33 else
+            int(time()) + 21600}
+            for a_id in StandInStravaAthletes.athletes}
+        with open(f'{folder}/strava_tokens.json',
+            'w') as f:
+            json.dump(tokens, f)
+        os.chdir(folder)
+
+    def sync(self, sync_workers):
+        folder = tempfile.mkdtemp()
+        try:
+            self.setup_folder(folder, sync_workers)
+            StandInStravaAthletes.requests = []
+            StandInStravaAthletes.refreshed = []
+            S = StravaData([], '')
+            s = time()
+            df = S.run_athletes()
+            t = time() - s
+            refreshed = StandInStravaAthletes.refreshed
+            requests = len(
+                StandInStravaAthletes.requests)
+            StandInStravaAthletes.requests = []
+            S = StravaData([], '')
+            df_again = S.run_athletes()
+        finally:
+            os.chdir(self.pwd)
+            shutil.rmtree(folder)
+        return df, t, requests, refreshed, df_again
+
+    def check_interrupted(self):
+        # A download that fails on page 2 saves nothing
+        # and keeps the sync state, the next sync gets
+        # every activity
+        folder = tempfile.mkdtemp()
+        try:
+            self.setup_folder(folder, 1)
+            StandInStravaAthletes.failed_pages = {22: 2}
+            df = StravaData([], '').run_athletes()
+            assert 22 not in set(df['athlete/id'])
+            StandInStravaAthletes.failed_pages = {}
+            df = StravaData([], '').run_athletes()
+            counts = df.groupby('athlete/id').size(
+                ).to_dict()
+            print(f'After an interrupted sync: {counts}')
+            assert counts == \
+                StandInStravaAthletes.athletes
+        finally:
+            StandInStravaAthletes.failed_pages = {}
+            os.chdir(self.pwd)
+            shutil.rmtree(folder)
+
+    def check_expiry(self):
+        # A token that expires during a download is
+        # refreshed before the next request instead of
+        # failing with 401
+        folder = tempfile.mkdtemp()
+        try:
+            self.setup_folder(folder, 1)
+            StandInStravaAthletes.refreshed = []
+            S = StravaData([], '')
+            TS = S.get_token_store()
+            F = S.get_fetcher(
+                lambda: TS.get_headers(11), 11)
+            assert len(F.get('athlete/activities',
+                {'page': 1, 'per_page': 5})) == 5
+            StandInStravaAthletes.expired.add(
+                TS.get_headers(11)['Authorization'])
+            TS.tokens['11']['expires_at'] = 0
+            assert len(F.get('athlete/activities',
+                {'page': 2, 'per_page': 5})) == 5
+            print('Refreshed during the download: '
+                f'{StandInStravaAthletes.refreshed}')
+            assert StandInStravaAthletes.refreshed == \
+                [11]
+        finally:
+            StandInStravaAthletes.expired = set()
+            os.chdir(self.pwd)
+            shutil.rmtree(folder)
+
+    def run(self):
+        df_serial, t_serial, _, _, _ = self.sync(1)
+        df, t, requests, refreshed, df_again = \
+            self.sync(3)
+        counts = df.groupby('athlete/id').size(
+            ).to_dict()
+        print(f'Activities per athlete: {counts}')
+        print(f'Serial {t_serial:.2f} s, parallel '
+            f'{t:.2f} s, {requests} requests')
+        print('Second sync: '
+            f'{len(StandInStravaAthletes.requests)} '
+            'requests')
+        assert counts == StandInStravaAthletes.athletes
+        assert df.id.is_unique
+        assert sorted(df.id) == sorted(df_serial.id)
+        assert sorted(df_again.id) == sorted(df.id)
+        assert refreshed == [33]
+        # One page per athlete when nothing is new
+        assert len(StandInStravaAthletes.requests) == 3
+        self.check_interrupted()
+        self.check_expiry()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    T = TestAthleteSync()
+    T.run()
@@ -3,10 +3,14 @@ import configparser
 from pathlib import Path
 from time import time
 
+import numpy as np
 import pandas as pd
+from scipy.spatial import KDTree
 
 from update_local_data2 import Datasets
 from coordinates_to_countries import CoordinatesToCountries
+from geo_index import InteriorGrid
+from geocode_cache import GeocodeCache
 from to_see_the_world import CountryData, Utils, Summary
 
 pd.set_option('display.max_rows', None)
@@ -143,12 +147,46 @@ class TestGetGeo():
             13227992363: 'LA,TH'
         }
         
-    def run(self, a_ids=[], output_geo= False):
+    def get_activities(self, a_ids=[]):
+        # Activities with coords of test_get_geo.pickle
+        # (only a_ids when given). Without the pickle,
+        # tracks across the boundary csv stand in
         pickle = f'{self.pwd}/test_get_geo.pickle'
+        if not Path(pickle).exists():
+            print(f'{pickle} not found, using tracks '
+                'across the boundaries instead')
+            return self.get_border_tracks()
         df  = pd.read_pickle(pickle)
         df = df.get(df['coords'].str.len() != 0)
         if a_ids:
             df = df.get(df.id.isin(a_ids))
+        return df
+
+    def get_border_tracks(self, num=300, length=20,
+        step=0.005):
+        # Straight tracks through random boundary
+        # points, so they cross or touch a border
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(self.df_cbs), num)
+        angle = rng.random(num) * 2 * np.pi
+        offset = (np.arange(length) - length / 2) * step
+        lat = self.df_cbs.lat.to_numpy(dtype=np.float64
+            )[rows, None] + np.sin(angle)[:, None] * offset
+        lon = self.df_cbs.lon.to_numpy(dtype=np.float64
+            )[rows, None] + np.cos(angle)[:, None] * offset
+        return pd.DataFrame({'id': np.arange(num),
+            'coords': [list(zip(a.tolist(), b.tolist()))
+            for a, b in zip(lat, lon)]})
+
+    def get_coords(self, df):
+        # Every point of df as run's input
+        df_explode = df[['id', 'coords']].explode(
+            'coords').dropna()
+        return {'id': list(df_explode.id.values),
+            'coords': list(df_explode['coords'].values)}
+
+    def run(self, a_ids=[], output_geo= False):
+        df = self.get_activities(a_ids)
             
         start = time()
         df = self.get_geo(df, slice=5)
@@ -191,6 +229,294 @@ class TestGetGeo():
                      df_aid, elevations=False,
                      fname=fname)
 
+    def compare_track_sampler(self, a_ids=[]):
+        # The slice=4 stride of syncs against the
+        # adaptive TrackSampler on the expected border
+        # crossings. The sampler must not lose any
+        # crossing slice=4 finds before it is enabled
+        df = self.get_activities(a_ids)
+        ans = {}
+        dfgs = {}
+        for name, kwargs in [
+            ('slice=4', {'slice': 4}),
+            ('adaptive', {'adaptive': True})]:
+            start = time()
+            dfgs[name] = self.CD.get_geo(
+                df.copy(), **kwargs)
+            end = time()
+            ans[name] = (
+                len(self.get_missed(dfgs[name])),
+                len(self.get_calc_bad(dfgs[name])))
+            print(f'{name}: {round(end - start, 2)} sec, '
+                f'missed BC: {ans[name][0]}, '
+                f'extra BCs: {ans[name][1]}')
+        lost = self.get_lost_crossings(
+            dfgs['slice=4'], dfgs['adaptive'])
+        print('Activities with crossings found by '
+            f'slice=4 but not adaptive: {len(lost)}')
+        for i, (a, b) in lost.items():
+            print(f'{self.get_strava_activity_link(i)} '
+                f'slice=4: {a}, adaptive: {b}')
+        ans['lost'] = len(lost)
+        # Never more missed expected crossings than
+        # slice=4
+        assert ans['adaptive'][0] <= ans['slice=4'][0]
+        return ans
+
+    def get_lost_crossings(self, df_ref, df):
+        # id -> (reference codes, codes) of activities
+        # missing a country or crossing of df_ref
+        codes = dict(zip(df.id, df.country_code))
+        crossings = dict(zip(df.id,
+            df.border_crossings))
+        lost = {}
+        for i, cc, bc in zip(df_ref.id,
+            df_ref.country_code, df_ref.border_crossings):
+            if i not in codes:
+                continue
+            if set(cc.split(',')) - set(codes[i].split(
+                ',')) or bc > crossings[i]:
+                lost[i] = (cc, codes[i])
+        return lost
+
+    def check_geodata_kdtree(self, a_ids=[]):
+        # The vectorized get_geodata_kdtree must
+        # match the original per point iloc lookup over
+        # the csv, fid dtype included
+        coords = self.get_coords(
+            self.get_activities(a_ids))
+        CTC = CoordinatesToCountries()
+        start = time()
+        df_new = CTC.get_geodata_kdtree(coords)
+        end = time()
+        df_old = self.get_geodata_kdtree_iloc(coords)
+        fid_new = [[a] if pd.isna(b) else [a, b]
+            for a, b in zip(df_new.fid, df_new.fid2)]
+        cc_new = [[a] if not b else [a, b]
+            for a, b in zip(df_new.country_code,
+            df_new.country_code2)]
+        same = (
+            list(df_new.id) == list(df_old.id) and
+            list(df_new.og_coord) == list(
+                df_old.og_coord) and
+            fid_new == list(df_old.fid) and
+            df_new.fid.dtype == self.df_cbs.fid.dtype and
+            cc_new == list(df_old.country_code))
+        print(
+            f'Elapsed time: {round(end - start, 2)} sec')
+        print('get_geodata_kdtree matches iloc version '
+            f'for {len(df_new)} points: {same}')
+        assert same
+        return same
+
+    def check_parallel(self, a_ids=[], workers=3):
+        # run_parallel must give the serial answer, the
+        # way the points are sharded must not matter
+        coords = self.get_coords(
+            self.get_activities(a_ids))
+        CTC = CoordinatesToCountries(
+            geocode_cache=False, workers=1)
+        df_serial = CTC.run(coords).reset_index(
+            drop=True)
+        same = True
+        for shard_deg in [5.0, 1.0, 0.1]:
+            with CoordinatesToCountries(
+                geocode_cache=False,
+                workers=workers) as CTC:
+                start = time()
+                df_parallel = CTC.run_parallel(coords,
+                    shard_deg=shard_deg).reset_index(
+                    drop=True)
+                end = time()
+            same_shard = df_serial.equals(df_parallel)
+            print(f'shard_deg {shard_deg}: '
+                f'{round(end - start, 2)} sec, same as '
+                f'serial for {len(df_serial)} rows: '
+                f'{same_shard}')
+            same &= same_shard
+        assert same
+        return same
+
+    def check_geocode_cache(self, a_ids=[]):
+        # Cached answers must come back row for row as
+        # the uncached ones, on a cold and a warm cache.
+        # Crossings depend on the point order
+        coords = self.get_coords(
+            self.get_activities(a_ids))
+        df_exact = CoordinatesToCountries(
+            geocode_cache=False, workers=1).run(
+            coords).reset_index(drop=True)
+        CTC = CoordinatesToCountries(
+            geocode_cache=True, workers=1)
+        # In memory, the cache file is not touched
+        CTC.GC = GeocodeCache(
+            cell_deg=CTC.GC.cell_deg,
+            max_cells=CTC.GC.max_cells,
+            version=CTC.GC.version)
+        same = True
+        for name in ['cold', 'warm']:
+            df = CTC.run(coords).reset_index(drop=True)
+            same_run = df_exact.equals(df)
+            print(f'Geocode cache {name}: same as '
+                f'uncached for {len(df_exact)} rows: '
+                f'{same_run}')
+            same &= same_run
+        print(CTC.GC.get_stats())
+        assert same
+        return same
+
+    def compare_interior_grid(self, a_ids=[]):
+        # The interior grid against the exact path.
+        # Every point the grid resolves differently
+        # must lie inside the polygon the grid gives
+        coords = self.get_coords(
+            self.get_activities(a_ids))
+        # Positions as ids, so the rows of both runs
+        # pair up
+        pos = {'id': np.arange(len(coords['id'])),
+            'coords': coords['coords']}
+        CTC = CoordinatesToCountries(
+            geocode_cache=False, workers=1)
+        IG = CTC.IG or InteriorGrid.load_cached(
+            CTC.config.get('path',
+            'fname_country_boundaries_shifted'),
+            cell_deg=CTC.config.getfloat(
+            'interior_grid', 'cell_deg',
+            fallback=0.1))
+        CTC.IG = None
+        df_exact = CTC.run(pos).set_index('id')
+        CTC.IG = IG
+        start = time()
+        df_grid = CTC.run(pos).set_index('id')
+        end = time()
+        print(IG.get_stats())
+        rows = df_exact.index.intersection(
+            df_grid.index)
+        cols = ['fid', 'country_code', 'admin_name',
+            'city']
+        diff = rows[(df_exact.loc[rows, cols] !=
+            df_grid.loc[rows, cols]).any(axis=1
+            ).to_numpy()]
+        points = np.asarray(coords['coords'],
+            dtype=np.float64).reshape(-1, 2)[diff]
+        inside = CTC.PIP.run(points[:, 0],
+            points[:, 1], np.arange(len(diff)),
+            CTC.BI.get_fid_codes(
+            df_grid.loc[diff, 'fid'].to_numpy()),
+            CTC.BI.get_polygon)
+        one_path = len(df_exact) + len(df_grid) - \
+            2 * len(rows)
+        print(f'Interior grid: {round(end - start, 2)} '
+            f'sec, {len(diff)} of {len(rows)} points '
+            'differ from the exact path, inside the '
+            f'grid polygon: {int(inside.sum())}, rows '
+            f'only on one path: {one_path}')
+        assert inside.all()
+        return len(diff)
+
+    def get_geodata_kdtree_iloc(self, coords):
+        # The implementation before the boundary index
+        df_cbs = self.df_cbs
+        data = list(zip(
+            list(df_cbs['lat']), list(df_cbs['lon'])))
+        tree = KDTree(data, leafsize=30)
+        _, ii = tree.query(coords['coords'], k=2,
+            workers=-1)
+        geo_data = {
+            'id': [], 'og_coord': [], 'fid': [],
+            'country_code': []}
+        for idx, i in enumerate(ii):
+            cc = []
+            fid = []
+            geo_data['id'].append(coords['id'][idx])
+            og_coord = coords['coords'][idx]
+            for ix in i:
+                cc_ans = df_cbs.iloc[[ix]
+                    ].country_code.values[0]
+                if cc_ans not in cc:
+                    cc.append(cc_ans)
+                fid_ans = df_cbs.iloc[[
+                    ix]].fid.values[0]
+                if fid_ans not in fid:
+                    fid.append(fid_ans)
+            geo_data['fid'].append(fid)
+            geo_data['country_code'].append(cc)
+            geo_data['og_coord'].append(og_coord)
+        return pd.DataFrame(geo_data)
+
+    def benchmark_points_in_polygon(self, a_ids=[]):
+        # Batched PointInPolygon against the original
+        # per polygon ray casting loop on the border
+        # crossing tracks
+        coords = self.get_coords(self.get_activities(
+            a_ids if a_ids else list(self.ans)))
+        CTC = CoordinatesToCountries()
+        dfg = CTC.get_geodata_kdtree(coords)
+        dfg = dfg.get(dfg.fid2.notna())
+        lat = dfg.lat.to_numpy()
+        lon = dfg.lon.to_numpy()
+        point_idx, fid_codes = CTC.BI.query_bbox(
+            lat, lon)
+        match = (fid_codes == CTC.BI.get_fid_codes(
+            dfg.fid.to_numpy())[point_idx]) | (
+            fid_codes == CTC.BI.get_fid_codes(
+            dfg.fid2.to_numpy())[point_idx])
+        point_idx = point_idx[match]
+        fid_codes = fid_codes[match]
+        print(f'{len(dfg)} ambiguous points, '
+            f'{len(point_idx)} point/polygon pairs, '
+            f'{len(set(fid_codes))} polygons')
+        start = time()
+        inside_old = np.zeros(len(point_idx), dtype=bool)
+        for fid_code in sorted(set(fid_codes)):
+            pairs = np.flatnonzero(fid_codes == fid_code)
+            points = list(zip(lat[point_idx[pairs]],
+                lon[point_idx[pairs]]))
+            inside = set(self.points_in_polygon_loop(
+                points, CTC.BI.get_polygon(fid_code)))
+            inside_old[pairs] = [
+                p in inside for p in points]
+        end_old = time() - start
+        start = time()
+        inside_new = CTC.PIP.run(lat, lon, point_idx,
+            fid_codes, CTC.BI.get_polygon)
+        end_new = time() - start
+        same = bool((inside_old == inside_new).all())
+        print('points_in_polygon loop: '
+            f'{round(end_old, 3)} sec')
+        print('PointInPolygon batch: '
+            f'{round(end_new, 3)} sec')
+        print(f'Results match: {same}')
+        assert same
+        return same
+
+    def points_in_polygon_loop(self, points, poly):
+        # Original CoordinatesToCountries version
+        x = np.array([point[0] for point in points])
+        y = np.array([point[1] for point in points])
+        poly_x = np.array([p[0] for p in poly])
+        poly_y = np.array([p[1] for p in poly])
+        n = len(poly)
+        inside = np.zeros(len(x), dtype=np.bool_)
+        for i in range(n):
+            p1x, p1y = poly_x[i], poly_y[i]
+            p2x, p2y = poly_x[(i + 1) % n], poly_y[
+                (i + 1) % n]
+            condition1 = (p1y <= y) & (p2y > y)
+            condition2 = (p2y <= y) & (p1y > y)
+            den = p2y - p1y
+            if den == 0:
+                intersect_x = p1x
+            else:
+                intersect_x = (p2x - p1x) * (y - p1y
+                    ) / den + p1x
+            condition3 = x < intersect_x
+            mask = (condition1 | condition2
+                ) & condition3
+            inside[mask] = ~inside[mask]
+        return [point for idx, point in enumerate(
+            points) if inside[idx]]
+
     def test(self):
         delta = 0.00001
         track = []
@@ -270,9 +596,7 @@ class TestGetGeo():
         for c in cc_list:
             if len(ans) > 0:
                 ans += ','
-            ans +=  list(self.CD.df_country_data.get(
-                self.CD.df_country_data.country_code \
-                == c)['country_name'])[0]
+            ans += self.CD.get_country_names()[c]
         return ans 
     
     def get_geo(self, df, slice=1):
@@ -315,4 +639,10 @@ if __name__ == "__main__":
     TGG.run(
         #a_ids=[10497533128], output_geo=True
         )
+    TGG.compare_track_sampler()
+    TGG.check_geodata_kdtree()
+    TGG.check_parallel()
+    TGG.check_geocode_cache()
+    TGG.compare_interior_grid()
+    TGG.benchmark_points_in_polygon()
     #TGG.test()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3.11
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from http_client import HttpClient
+
+
+class StandInServer(BaseHTTPRequestHandler):
+    """
+    /etag answers with an ETag and 304 when it
+    matches, /plain has no validators and /flaky
+    fails with 503 fail_count times, also for POST.
+    """
+    protocol_version = 'HTTP/1.1'
+    fail_count = 0
+    hits = []
+    ports = set()
+    not_modified = 0
+
+    def do_GET(self):
+        cls = type(self)
+        cls.hits.append(self.path)
+        cls.ports.add(self.client_address[1])
+        if self.path == '/etag':
+            if self.headers.get(
+                'If-None-Match') == '"v1"':
+                cls.not_modified += 1
+                return self.send(304, None,
+                    {'ETag': '"v1"'})
+            return self.send(200, {'data': 'etag'},
+                {'ETag': '"v1"'})
+        if self.path == '/flaky' and cls.fail_count:
+            cls.fail_count -= 1
+            return self.send(503, {'message': 'busy'})
+        return self.send(200, {'data': self.path})
+
+    def do_POST(self):
+        self.rfile.read(int(
+            self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def send(self, status, body, headers={}):
+        data = json.dumps(body).encode() if body \
+            else b''
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', len(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpClient():
+    def __init__(self):
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), StandInServer)
+        threading.Thread(
+            target=self.server.serve_forever,
+            daemon=True).start()
+        self.base_url = ('http://127.0.0.1:'
+            f'{self.server.server_address[1]}')
+        self.cache_folder = tempfile.mkdtemp()
+
+    def reset(self):
+        StandInServer.hits = []
+        StandInServer.ports = set()
+        StandInServer.not_modified = 0
+
+    def run(self):
+        # Keep-alive: one connection for many requests
+        self.reset()
+        H = HttpClient(backoff=0.01)
+        for _ in range(10):
+            assert H.get(f'{self.base_url}/plain'
+                ).json() == {'data': '/plain'}
+        print(f'Keep-alive: {len(StandInServer.hits)} '
+            f'requests, {len(StandInServer.ports)} '
+            'connections')
+        assert len(StandInServer.hits) == 10
+        assert len(StandInServer.ports) == 1
+
+        # Retry with backoff
+        self.reset()
+        StandInServer.fail_count = 2
+        r = H.get(f'{self.base_url}/flaky')
+        print(f'Retry: status {r.status_code} after '
+            f'{len(StandInServer.hits)} requests')
+        assert r.status_code == 200
+        assert len(StandInServer.hits) == 3
+
+        # POST is not replayed
+        self.reset()
+        StandInServer.fail_count = 2
+        r = H.post(f'{self.base_url}/flaky',
+            data={'code': 'once'})
+        print(f'POST: status {r.status_code} after '
+            f'{len(StandInServer.hits)} requests')
+        assert r.status_code == 503
+        assert len(StandInServer.hits) == 1
+        StandInServer.fail_count = 0
+
+        # ETag revalidation
+        self.reset()
+        H = HttpClient(cache_folder=self.cache_folder)
+        first = H.get(f'{self.base_url}/etag')
+        second = HttpClient(
+            cache_folder=self.cache_folder).get(
+            f'{self.base_url}/etag')
+        print('ETag: second answer from cache: '
+            f'{getattr(second, "from_cache", False)}')
+        assert first.json() == second.json()
+        assert second.from_cache
+        assert len(StandInServer.hits) == 2
+        # The second request was a revalidation
+        assert StandInServer.not_modified == 1
+        assert not getattr(first, 'from_cache', False)
+
+        # max_age for answers without validators
+        self.reset()
+        H = HttpClient(cache_folder=self.cache_folder,
+            max_age=60)
+        H.get(f'{self.base_url}/plain')
+        r = H.get(f'{self.base_url}/plain')
+        print('max_age: requests sent '
+            f'{len(StandInServer.hits)}')
+        assert r.json() == {'data': '/plain'}
+        assert len(StandInServer.hits) == 1
+        H = HttpClient(cache_folder=self.cache_folder)
+        H.get(f'{self.base_url}/plain')
+        assert len(StandInServer.hits) == 2
+
+        # Answers are kept per athlete, not per token
+        self.reset()
+        H = HttpClient(cache_folder=self.cache_folder,
+            max_age=60)
+        for token, a_id in [('a', 1), ('b', 1), ('c', 2)]:
+            H.get(f'{self.base_url}/athlete',
+                headers={'Authorization': token},
+                cache_key=a_id)
+        print('cache_key: requests sent '
+            f'{len(StandInServer.hits)}')
+        assert len(StandInServer.hits) == 2
+        H = HttpClient(cache_folder=self.cache_folder,
+            max_age=60)
+        assert H.get(f'{self.base_url}/athlete',
+            headers={'Authorization': 'd'},
+            cache_key=2).from_cache
+
+        # The least recently used answers are dropped
+        # above max_cache_mb
+        self.reset()
+        H = HttpClient(cache_folder=self.cache_folder,
+            max_age=60, max_cache_mb=0)
+        H.prune_every = 1
+        H.get(f'{self.base_url}/plain')
+        H.get(f'{self.base_url}/plain')
+        print('max_cache_mb: requests sent '
+            f'{len(StandInServer.hits)}')
+        assert len(StandInServer.hits) == 2
+        assert len(os.listdir(self.cache_folder)) == 0
+
+        shutil.rmtree(self.cache_folder)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    T = TestHttpClient()
+    T.run()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3.11
+import os
+import tempfile
+import threading
+from time import sleep, time
+
+from rate_scheduler import RateScheduler
+
+
+class TestRateScheduler():
+    def __init__(self):
+        self.folder = tempfile.mkdtemp()
+        self.fname = f'{self.folder}/rate_budget.json'
+
+    def get_scheduler(self, buckets, name='test',
+        rolling=()):
+        return RateScheduler(name, buckets,
+            fname=self.fname,
+            header_buckets=['short', 'long'] if
+            'short' in buckets else [],
+            rolling=rolling)
+
+    def run(self):
+        # The budget used by one run is left for the
+        # next one
+        S = self.get_scheduler({'short': (5, 3600),
+            'long': (100, 86400)})
+        for _ in range(3):
+            S.acquire()
+            S.release()
+        S = self.get_scheduler({'short': (5, 3600),
+            'long': (100, 86400)})
+        print('Used after reload: '
+            f'{S.buckets["short"]["used"]}')
+        assert S.buckets['short']['used'] == 3
+        for _ in range(2):
+            S.acquire()
+            S.release()
+        # Until the end of the hour window
+        assert 1 < S.get_wait_time() <= 3600
+        assert S.buckets['long']['used'] == 5
+
+        # Strava headers set usage and limits, the
+        # highest usage wins
+        S.release({'X-RateLimit-Limit': '600,30000',
+            'X-RateLimit-Usage': '7,40'})
+        S.release({'X-RateLimit-Limit': '600,30000',
+            'X-RateLimit-Usage': '6,39'})
+        assert S.buckets['short']['limit'] == 600
+        assert S.buckets['short']['used'] == 7
+        assert S.buckets['long']['used'] == 40
+        assert S.get_wait_time() == 0
+
+        # 429s wait for the end of the short window,
+        # not the day, unless the headers say so
+        S.release({}, limited=True)
+        S.release({}, limited=True)
+        assert S.buckets['short']['used'] == 600
+        assert S.buckets['long']['used'] == 40
+        assert 0 < S.get_wait_time() <= 3600
+        S.release({'X-RateLimit-Limit': '600,30000',
+            'X-RateLimit-Usage': '8,30000'},
+            limited=True)
+        assert S.buckets['long']['used'] == 30000
+
+        # Retry-After is honoured instead
+        S = self.get_scheduler({'short': (5, 3600),
+            'long': (100, 86400)}, name='retry')
+        S.release({'Retry-After': '2'}, limited=True)
+        assert S.buckets['short']['used'] == 0
+        assert 1 < S.get_wait_time() <= 2
+        s = time()
+        S.acquire()
+        S.release()
+        print(f'Retry-After 2: {time() - s:.2f} s')
+        assert time() - s > 1.5
+        assert S.get_wait_time() == 0
+
+        # One request per second: requests are spaced
+        # by the budget, and new work waiting for a
+        # token goes ahead of backfill work that
+        # arrived first
+        S = self.get_scheduler({'second': (1, 1),
+            'day': (1000, 86400)}, name='otd',
+            rolling=['second'])
+        S.acquire()
+        starts = [time()]
+        S.release()
+        order = []
+        def work(name, priority):
+            S.acquire(priority)
+            starts.append(time())
+            order.append(name)
+            S.release()
+        threads = [threading.Thread(target=work,
+            args=(f'backfill {i}',
+            RateScheduler.BACKFILL)) for i in range(2)]
+        threads.append(threading.Thread(target=work,
+            args=('new', RateScheduler.NEW)))
+        for t in threads:
+            t.start()
+            sleep(0.05)
+        for t in threads:
+            t.join()
+        print(f'Order: {order}')
+        assert order == ['new', 'backfill 0',
+            'backfill 1']
+        gaps = [b - a for a, b in zip(starts[:-1],
+            starts[1:])]
+        print(f'Gaps: {[round(g, 2) for g in gaps]}')
+        assert min(gaps) > 0.95
+        assert S.buckets['day']['used'] == 4
+
+        # Used up budgets suspend the work until the
+        # window ends instead of failing
+        S = self.get_scheduler({'second': (2, 2),
+            'day': (1000, 86400)}, name='suspend')
+        s = time()
+        for _ in range(6):
+            S.acquire()
+            S.release()
+        t = time() - s
+        print(f'6 requests at 2 per 2 s: {t:.2f} s')
+        assert 2 < t < 6.5
+        assert S.buckets['day']['used'] == 6
+        os.remove(self.fname)
+        os.rmdir(self.folder)
+
+
+if __name__ == "__main__":
+    T = TestRateScheduler()
+    T.run()
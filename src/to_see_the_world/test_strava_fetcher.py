@@ -0,0 +1,200 @@
+#!/usr/bin/env python3.11
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import threading
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from strava_fetcher import StravaFetcher
+
+
+class StandInStrava(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the Strava API. Serves
+    /athlete and /athlete/activities (newest first)
+    with rate limit headers, a fixed latency and an
+    optional number of 429 answers.
+    """
+    num_activities = 950
+    latency = 0.1
+    short_limit = 600
+    long_limit = 30000
+    fail_429 = 0
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in
+            parse_qs(url.query).items()}
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append((url.path, query))
+            usage = len(cls.requests)
+            limited = cls.fail_429 > 0
+            cls.fail_429 -= 1
+        sleep(cls.latency)
+        if limited:
+            self.send(429, {'message': 'Rate Limit '
+                'Exceeded'}, usage)
+        elif url.path == '/athlete':
+            self.send(200, {'id': 1}, usage)
+        elif url.path == '/athlete/activities':
+            page = int(query.get('page', 1))
+            per_page = int(query.get('per_page', 30))
+            ids = range((page - 1) * per_page, min(
+                page * per_page, self.num_activities))
+            self.send(200,
+                [self.get_activity(i) for i in ids],
+                usage)
+        else:
+            self.send(404, {'message': 'Not Found'},
+                usage)
+
+    def get_activity(self, i):
+        start = datetime(2024, 1, 1) - timedelta(days=i)
+        return {'id': 10000 - i, 'athlete': {'id': 1},
+            'name': f'Ride {i}', 'start_date_local':
+            start.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    def send(self, status, body, usage):
+        cls = type(self)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type',
+            'application/json')
+        self.send_header('Content-Length', len(data))
+        self.send_header('X-RateLimit-Limit',
+            f'{cls.short_limit},{cls.long_limit}')
+        self.send_header('X-RateLimit-Usage',
+            f'{usage},{usage}')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestStravaFetcher():
+    def __init__(self):
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), StandInStrava)
+        threading.Thread(
+            target=self.server.serve_forever,
+            daemon=True).start()
+        self.base_url = ('http://127.0.0.1:'
+            f'{self.server.server_address[1]}')
+
+    def get_fetcher(self, **kwargs):
+        StandInStrava.requests = []
+        return StravaFetcher({'Authorization':
+            'Bearer test'}, base_url=self.base_url,
+            **kwargs)
+
+    def fetch(self, F, final_time, per_page=100):
+        # Same page loop as StravaData.run
+        ids = []
+        for page, response in F.get_pages(
+            'athlete/activities', per_page=per_page):
+            done = False
+            for r in response:
+                if datetime.strptime(
+                    r['start_date_local'],
+                    '%Y-%m-%dT%H:%M:%SZ') <= final_time:
+                    done = True
+                    break
+                ids.append(r['id'])
+            if done:
+                break
+        return ids
+
+    def run(self):
+        final_time = datetime(2009, 1, 1)
+        s = time()
+        ids_serial = self.fetch(self.get_fetcher(
+            workers=1, prefetch=1), final_time)
+        t_serial = time() - s
+        s = time()
+        F = self.get_fetcher(workers=4, prefetch=4)
+        ids = self.fetch(F, final_time)
+        t = time() - s
+        print(f'Full import: {len(ids)} activities, '
+            f'serial {t_serial:.2f} s, concurrent '
+            f'{t:.2f} s')
+        assert ids == ids_serial
+        # Pages are fetched concurrently
+        assert t < t_serial
+        assert ids == [10000 - i for i in range(
+            StandInStrava.num_activities)]
+        # Prefetched pages still in flight
+        sleep(2 * StandInStrava.latency)
+        assert F.scheduler.buckets['short'][
+            'used'] == len(StandInStrava.requests)
+
+        # Incremental sync: the cutoff is on page 1
+        F = self.get_fetcher(workers=4, prefetch=4)
+        ids = self.fetch(F, datetime(2023, 12, 1))
+        sleep(2 * StandInStrava.latency)
+        print(f'Incremental sync: {len(ids)} activities,'
+            f' {len(StandInStrava.requests)} requests')
+        assert len(ids) == 31
+        assert len(StandInStrava.requests) == 1
+
+        # 429 answers are waited out and retried
+        F = self.get_fetcher(workers=4, prefetch=4)
+        F.scheduler.get_wait_time = lambda: 0
+        StandInStrava.fail_429 = 2
+        assert F.get('athlete') == {'id': 1}
+        print('429 retry: '
+            f'{len(StandInStrava.requests)} requests')
+        assert len(StandInStrava.requests) == 3
+
+        # Once the retries are used up the download
+        # fails instead of ending early
+        F = self.get_fetcher(max_retries=1)
+        F.scheduler.get_wait_time = lambda: 0
+        StandInStrava.fail_429 = 5
+        try:
+            list(F.get_pages('athlete/activities'))
+            raise AssertionError('No error raised')
+        except requests.exceptions.HTTPError as e:
+            print(f'429 retries used up: {e}')
+            assert e.response.status_code == 429
+        # One page, tried max_retries + 1 times
+        assert len(StandInStrava.requests) == 2
+        StandInStrava.fail_429 = 0
+
+        # Requests wait while the 15 minute quota is
+        # used up
+        F = self.get_fetcher(workers=4, prefetch=4)
+        waits = []
+        get_wait_time = F.scheduler.get_wait_time
+        def wait_time():
+            wait = get_wait_time()
+            if wait > 1:
+                waits.append(wait)
+                F.scheduler.buckets['short'][
+                    'used'] = 0
+                return 0.01
+            return wait
+        F.scheduler.get_wait_time = wait_time
+        StandInStrava.short_limit = 5
+        ids = self.fetch(F, final_time)
+        StandInStrava.short_limit = 600
+        print(f'Quota waits: {len(waits)}')
+        assert len(ids) == StandInStrava.num_activities
+        assert waits
+        # Until the end of the 15 minute window, never
+        # the day
+        assert all(1 < w <= 900 for w in waits)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    T = TestStravaFetcher()
+    T.run()
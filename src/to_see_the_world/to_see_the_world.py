@@ -1,5 +1,6 @@
 #!/usr/bin/env python3.11
-from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 import configparser
 from datetime import datetime
 import glob
@@ -7,23 +8,32 @@ from math import radians, sin, cos, acos
 import os
 from pathlib import Path
 import re
-import time
 
 from flatten_dict import flatten
 import folium
 from folium.plugins import TimestampedGeoJson
 import gpxpy.gpx
+import numpy as np
 import pandas as pd
 import polyline
 from pretty_html_table import build_table
 import requests
 from stravalib import Client, exc
 from stravalib.util.limiter import DefaultRateLimiter
-from thefuzz import process, fuzz
 from wordcloud import WordCloud, STOPWORDS
 import xyzservices.providers as xyz
 
+from activity_geo_cache import ActivityGeoCache
+from activity_store import ActivityStore
+from admin_matcher import AdminMatcher
+from compiled_data import CountryTable
 from coordinates_to_countries import CoordinatesToCountries
+from http_client import HttpClient
+from rate_scheduler import RateScheduler
+from strava_fetcher import StravaFetcher
+from sync_state import SyncState
+from token_store import TokenStore
+from track_sampler import TrackSampler
 
 
 class Utils:
@@ -46,13 +56,24 @@ class Utils:
         return pd.DataFrame(
             columns = self.col_names)
     
-    def create_base(self, pickles):
-         df_base = self.setup_df()
-         for pickle in pickles:
-             df_tmp = pd. read_pickle(pickle)
-             df_base = pd.concat(
-             [df_base, df_tmp], ignore_index=True)
-         return df_base
+    def get_activity_store(self, pickles=[]):
+        # Pickle files of older versions are copied
+        # into the store on first use
+        folder = self.config.get(
+            'path', 'activity_store_folder')
+        AS = ActivityStore(f'{self.pwd}/{folder}')
+        AS.migrate(pickles)
+        return AS
+
+    def load_activities(self, pickles, a_ids=None,
+        s_time_str='', e_time_str='', columns=None,
+        years=None):
+        df = self.get_activity_store(pickles).load(
+            a_ids, s_time_str, e_time_str, columns,
+            years)
+        if len(df) == 0:
+            return self.setup_df()
+        return df
     
     def get_a_id_list(self, df):
         return list(set(df.get('athlete/id', {0})))
@@ -60,6 +81,54 @@ class Utils:
     def get_cc(self, df, id):
         return df.get(df.id == id
             ).country_code.values[0].split(',')
+
+    def split_codes(self, codes):
+        """
+        Categorical view of comma joined codes. Returns
+        the category of every row (-1 for missing) and
+        the code list of every category, so each
+        distinct string is only split once.
+        """
+        cat = pd.Categorical(codes)
+        return cat.codes, [
+            [c.strip() for c in str(x).split(',')]
+            for x in cat.categories]
+
+    def map_codes(self, codes, lookup, sep=','):
+        # Maps every code through lookup and joins the
+        # results per row. Unknown codes are dropped
+        rows, code_lists = self.split_codes(codes)
+        mapped = np.array([sep.join(
+            lookup[c] for c in code_list if c in lookup)
+            for code_list in code_lists] + [''],
+            dtype=object)
+        return pd.Series(mapped[rows],
+            index=getattr(codes, 'index', None))
+
+    def get_code_parts(self, codes):
+        # First code, second code ('' if none) and
+        # number of codes of every row
+        rows, code_lists = self.split_codes(codes)
+        code_lists.append([''])
+        first = np.array([x[0] for x in code_lists])
+        second = np.array([(x + [''])[1]
+            for x in code_lists])
+        num = np.array([len(x) for x in code_lists])
+        return first[rows], second[rows], num[rows]
+
+    def has_codes(self, codes, code):
+        # Row wise test of code[i] in codes[i]
+        return np.char.find(
+            np.char.add(np.char.add(',', codes), ','),
+            np.char.add(np.char.add(',', code), ',')
+            ) >= 0
+
+    def has_code(self, codes, code):
+        # Row mask of the joined codes holding code
+        rows, code_lists = self.split_codes(codes)
+        hit = np.array([code in code_list
+            for code_list in code_lists] + [False])
+        return hit[rows]
         
     def limit_time(self, time_str, df, start=True):
         if time_str:
@@ -113,198 +182,357 @@ class CountryData:
     def __init__(self, fname_country_data):
         # Namibia (NA) is read as NaN
         self.U = Utils()
-        self.df_country_data = pd.read_csv(
-            fname_country_data, na_filter = False)
+        # Columns are decoded when first needed
+        self.CT = CountryTable.load_cached(
+            fname_country_data)
+        self.fname_country_data = fname_country_data
+        self.country_names = None
         self.ratio = 70
+        self.CTC = None
+        self.AM = None
+        self.TS = None
+        self.AGC = None
+
+    def get_country_names(self):
+        if self.country_names is None:
+            self.country_names = dict(zip(
+                self.CT.get_column('country_code'),
+                self.CT.get_column('country_name')))
+        return self.country_names
 
     def get_country_centroids(self):
-        df_cd = self.df_country_data
-        df_cd['country_centroid'] = \
-            df_cd.country_centroid.apply(
-            lambda x: literal_eval(str(x)))
-        return self.df_country_data[[
+        # country_centroid is parsed into tuples when
+        # country_data is compiled
+        return self.CT.to_frame([
             'country_code',
             'country_name',
-            'country_centroid']].drop_duplicates()
-
-    def get_adm_areas_remain(
-        self, adm_visit, tuple_adm):
-        adm_visit.sort()
-        tuple_adm.sort()
-        list_adm = [x[0] for x in tuple_adm]
-        adm_remain = tuple_adm
-        visit_official = []
-        for visit in adm_visit:
-            ans = False
-            matches = process.extract(
-                visit,
-                list_adm,
-                scorer=fuzz.ratio)
-            if matches:
-                first_match = matches[0]
-                if first_match[1] >= self.ratio:
-                    ans = (first_match[0],
-                                dict(tuple_adm)[first_match[0]])
-                else:
-                    for match in matches:
-                        if fuzz.partial_ratio(
-                            visit, match[0]) >= self.ratio:
-                            ans = (match[0],
-                                        dict(tuple_adm)[match[0]])
-                            break
-            if ans:
-                adm_remain = [
-                    i for i in adm_remain if i != ans]
-                visit_official.append(ans)
-            else:
-                pass
-                #print(f'{visit} has no match')
+            'country_centroid']).drop_duplicates()
+
+    def get_admin_matcher(self):
+        if self.AM is None:
+            fname = self.U.config.get('path',
+                'fname_admin_match_memo', fallback='')
+            self.AM = AdminMatcher(
+                self.CT.to_frame(['country_code',
+                'admin_name', 'admin_type']),
+                ratio=self.ratio,
+                fname=f'{self.U.pwd}/{fname}'
+                    if fname else '',
+                version=self.CT.read_meta().get(
+                'sha256', ''))
+        return self.AM
+
+    def save_admin_matches(self):
+        if self.AM is not None:
+            self.AM.save()
+
+    def get_adm_areas_remain(self, adm_visit, cc):
+        AM = self.get_admin_matcher()
+        visit_official = [ans for ans in AM.match(
+            cc, sorted(adm_visit)) if ans]
+        matched = set(visit_official)
+        adm_remain = [i for i in AM.get_tuple_adm(cc)
+            if i not in matched]
         return dict(adm_remain), dict(visit_official)
 
-    def get_geo(self, df, slice=1):
-        df_explode = df[['id', 'coords']].explode(
-            'coords').dropna()
-        coords_slice = {'id': list(df_explode.id.values
-            )[::slice], 'coords': list(df_explode['coords'
-            ].values)[::slice]}
-        print('Finding coordinate meta data for '
-            f'{len(coords_slice["id"])} points')
-        CTC = CoordinatesToCountries()
-        df_slice = CTC.run(coords_slice)
+    def get_geo(self, df, slice=1, adaptive=False):
+        # adaptive replaces the fixed slice stride with
+        # the boundary aware TrackSampler
+        AGC = self.get_activity_geo_cache()
+        df_cached = None
+        if AGC is not None:
+            keys = AGC.get_keys(df,
+                self.get_sampling_key(slice, adaptive))
+            # One entry per id, like the summary. Rows
+            # of a repeated id are geocoded together
+            first = ~df.id.duplicated().to_numpy()
+            hit, df_cached = AGC.lookup(
+                df.id[first], keys[first])
+            print(AGC.get_stats(hit.sum(), len(hit)))
+            new_keys = dict(zip(df.id[first][~hit],
+                keys[first][~hit]))
+            df_new = df[df.id.isin(new_keys).to_numpy()]
+        else:
+            df_new = df
+        num_points = int(df_new.coords.str.len().sum())
+        chunk_size = self.U.config.getint(
+            'data', 'geo_chunk_size', fallback=100000)
+        if adaptive:
+            print('Sampling coordinates of '
+                f'{num_points} points')
+            chunks = self.get_sampled_chunks(
+                self.get_coord_chunks(
+                df_new, 1, chunk_size))
+        else:
+            print('Finding coordinate meta data for '
+                f'{len(range(0, num_points, slice))} '
+                'points')
+            chunks = self.get_coord_chunks(
+                df_new, slice, chunk_size)
+        CTC = self.get_coordinates_to_countries()
+        if CTC.IG is not None and num_points > 0:
+            print(CTC.IG.get_stats())
+        df_slices = []
+        for df_chunk in CTC.run_chunks(chunks):
+            df_slices.append(
+                self.get_geo_summary(df_chunk))
+            if AGC is not None:
+                AGC.update(new_keys, df_slices[-1],
+                    self.get_country_runs(df_chunk))
+        if CTC.GC is not None and num_points > 0:
+            print(CTC.GC.get_stats())
+        if AGC is not None:
+            # Activities without a resolved point are
+            # cached as empty, so they are not computed
+            # on every run
+            done = set()
+            for df_chunk in df_slices:
+                done.update(df_chunk.id)
+            AGC.update_empty(new_keys,
+                [i for i in new_keys if i not in done])
+            AGC.save()
+            if len(df_cached) > 0:
+                df_slices.append(df_cached)
+        if df_slices:
+            df_slice = pd.concat(
+                df_slices, ignore_index=True)
+        else:
+            df_slice = pd.DataFrame(columns=[
+                'id', 'country_code', 'admin_name',
+                'border_crossings'])
+        if df_cached is not None and len(df_cached) > 0:
+            # Back to the order of df
+            df_slice = df_slice.iloc[np.argsort(
+                pd.Index(df.id.drop_duplicates()
+                ).get_indexer(df_slice.id),
+                kind='stable')]
+        df = pd.merge(
+            df, df_slice[['id',
+            'country_code', 'admin_name',
+            'border_crossings']], on='id', how='right')
+        df.coords = df.coords.apply(tuple)
+        df['country_name'] = \
+            self.country_code_to_country_name(
+            df.country_code)
+        return df
+
+    def get_coord_chunks(self, df, slice=1,
+        chunk_size=100000):
+        # Yields (id, lat, lon) arrays holding every
+        # slice'th point of the exploded coords. All
+        # rows of an id are kept in one chunk, also
+        # when they are not next to each other in df
+        order = np.argsort(pd.factorize(df.id)[0],
+            kind='stable')
+        ids = []
+        lats = []
+        lons = []
+        size = 0
+        pos = 0
+        last = None
+        for i, coords in zip(df.id.values[order],
+            df.coords.values[order]):
+            if not isinstance(coords, (list, tuple)) \
+                or len(coords) == 0:
+                continue
+            if size >= chunk_size and i != last:
+                yield (np.concatenate(ids),
+                    np.concatenate(lats),
+                    np.concatenate(lons))
+                ids, lats, lons, size = [], [], [], 0
+            points = np.asarray(
+                coords, dtype=np.float64)[
+                (-pos) % slice::slice]
+            pos += len(coords)
+            if len(points) == 0:
+                continue
+            ids.append(np.full(len(points), i))
+            lats.append(points[:, 0])
+            lons.append(points[:, 1])
+            size += len(points)
+            last = i
+        if ids:
+            yield (np.concatenate(ids),
+                np.concatenate(lats),
+                np.concatenate(lons))
+
+    def get_sampling_key(self, slice, adaptive):
+        if not adaptive:
+            return f'slice={slice}'
+        TS = self.get_track_sampler()
+        return (f'adaptive{TS.version}={TS.min_step_deg},'
+            f'{TS.max_step_deg},{TS.near_deg},'
+            f'{TS.step_ratio}')
+
+    def get_activity_geo_cache(self):
+        config = self.U.config
+        if not config.getboolean('activity_geo_cache',
+            'enabled', fallback=False):
+            return None
+        if self.AGC is None:
+            CTC = self.get_coordinates_to_countries()
+            self.AGC = ActivityGeoCache(
+                fname=f'{self.U.pwd}/' + config.get(
+                'path', 'fname_activity_geo_cache'),
+                dataset_version=(f'{CTC.get_version()}:'
+                f"{CTC.CI.CT.read_meta().get('sha256', '')}"))
+        return self.AGC
+
+    def get_sampled_chunks(self, chunks):
+        TS = self.get_track_sampler()
+        for ids, lat, lon in chunks:
+            keep = TS.run(ids, lat, lon)
+            print('Finding coordinate meta data for '
+                f'{keep.sum()} of {len(keep)} points')
+            yield ids[keep], lat[keep], lon[keep]
+
+    def get_track_sampler(self):
+        if self.TS is None:
+            config = self.U.config
+            self.TS = TrackSampler(
+                self.get_coordinates_to_countries().BI,
+                min_step_deg=config.getfloat(
+                    'track_sampler', 'min_step_deg',
+                    fallback=0.001),
+                max_step_deg=config.getfloat(
+                    'track_sampler', 'max_step_deg',
+                    fallback=0.05),
+                near_deg=config.getfloat(
+                    'track_sampler', 'near_deg',
+                    fallback=0.05),
+                step_ratio=config.getfloat(
+                    'track_sampler', 'step_ratio',
+                    fallback=0.25))
+        return self.TS
+
+    def get_geo_summary(self, df_slice):
         border_crossings = \
             self.check_border_crossings(df_slice)
-        df_slice['border_crossings'] = \
-            df_slice.id.apply(
-            lambda x: border_crossings[x])
         df_slice = df_slice.drop_duplicates(
             subset=['id', 'country_code', 'admin_name'])
         df_slice = df_slice.groupby('id').agg(
             {'country_code': 
                  lambda x: ','.join(list(dict.fromkeys(x))),
-             'admin_name': ','.join,
-             'border_crossings': 'mean'}).reset_index()
-        df = pd.merge(
-            df, df_slice[['id',
-            'country_code', 'admin_name',
-            'border_crossings']], on='id', how='right')
-        df.coords = df.coords.apply(tuple)
-        #df = self.edit_borders(df)
-        df['country_name'] = df.country_code.apply(
-            lambda x: \
-            self.country_code_to_country_name(x))
-        return df
+             'admin_name': ','.join}).reset_index()
+        df_slice['border_crossings'] = \
+            border_crossings.reindex(
+            df_slice.id).to_numpy()
+        return df_slice
+
+    def get_coordinates_to_countries(self):
+        # Keep one instance so the boundary index and
+        # cities are only loaded once per process
+        if self.CTC is None:
+            self.CTC = CoordinatesToCountries()
+        return self.CTC
+
+    def close(self):
+        # Stops the geocoding processes, if any
+        if self.CTC is not None:
+            self.CTC.close()
 
     def edit_borders(self, df):
+        """
+        Activities with border crossings that their
+        date-sorted neighbours don't back up get the
+        country_code of the previous activity. A
+        rewritten code is the previous code of the next
+        activity, so the shifted rules are applied in
+        passes until no code changes.
+        """
         df = df.sort_values(by='start_date_local')
-        df_a = df.get(df.border_crossings > 1)
-        ids = list(df.id.values)
-        a_ids = list(df_a.id.values)
         if df.shape[0] <= 3:
             return df
-        for idx, i in enumerate(ids):
-            if i not in a_ids:
-                continue
-            prev_id = ids[idx - 1]
-            cur_id = i
-            next_id = ids[idx + 1]
-            prev_cc = self.U.get_cc(df, prev_id)
-            cur_cc = self.U.get_cc(df, cur_id)
-            next_cc = self.U.get_cc(df, next_id)
-            bc = df.get(df.id == cur_id
-                ).border_crossings.values[0]
-            len_next_cc = len(next_cc)
-            if len(cur_cc) == 1:
-                # Skipping, odd data
-                continue
-            if len_next_cc == 1:
-                if bc == 2:
-                    # Check for standard border crossing
-                    if prev_cc == next_cc:
-                        # No border crossing.
-                        # Set current cur_cc to prev_cc
-                        df.loc[df.id == cur_id, 'country_code'
-                            ] = ','.join(prev_cc)
-                    elif cur_cc[0] in prev_cc and \
-                        cur_cc[1] == next_cc[0]:
-                        # A border was crossed,
-                        # cur_cc is valid
-                        pass
-                    else:
-                        # Inconclusive,
-                        # set cur_cc to prev_cc
-                        df.loc[df.id == cur_id, 'country_code'
-                            ] = prev_cc
-                elif bc == 3:
-                    # Check for country crossing,
-                    # note: cannot currently check for
-                    # re-entering the original country
-                    if prev_cc == cur_cc[0] \
-                        and len(cur_cc) == 3:
-                        # A country was crossed.
-                        # cur_cc is valid
-                        pass
-                    else:
-                        # Inconclusive.
-                        # Set cur_cc to prev_cc
-                        df.loc[df.id == cur_id, 'country_code'
-                            ] = ','.join(prev_cc)
-                else:
-                    # bc > 3, the data very likely bad.
-                    # Set cur_cc to prev_cc
-                    df.loc[df.id == cur_id, 'country_code'
-                        ] = ','.join(prev_cc)
-            elif len_next_cc == 2:
-                if cur_cc[0] in prev_cc and \
-                    cur_cc[1] == next_cc[0]:
-                    # A country was crossed.
-                    # cur_cc is valid
-                    pass
-                else:
-                    # Inconclusive,
-                    # set cur_cc to prev_cc
-                    df.loc[df.id == cur_id, 'country_code'
-                        ] = ','.join(prev_cc)
-            else:
-                # len(next_cc) > 1. There is likely
-                # some bad data. Set cur_cc to prev_cc  
-                df.loc[df.id == cur_id, 'country_code'
-                    ] = ','.join(prev_cc)
+        cc = df.country_code.fillna('').to_numpy(
+            dtype=str)
+        first, second, num = self.U.get_code_parts(cc)
+        bc = df.border_crossings.to_numpy()
+        # Skipping single codes (odd data) and the
+        # first and last activity, which lack a
+        # neighbour
+        check = (bc > 1) & (num > 1)
+        check[[0, -1]] = False
+        next_cc = np.roll(cc, -1)
+        next_first = np.roll(first, -1)
+        next_num = np.roll(num, -1)
+        new_cc = cc
+        while True:
+            prev_cc = np.roll(new_cc, 1)
+            # A border was crossed from prev into next
+            crossed = self.U.has_codes(
+                prev_cc, first) & (second == next_first)
+            valid = np.select([
+                (next_num == 1) & (bc == 2),
+                (next_num == 1) & (bc == 3),
+                next_num == 2], [
+                (prev_cc != next_cc) & crossed,
+                # A country was crossed. Note: cannot
+                # currently check for re-entering the
+                # original country
+                (prev_cc == first) & (num == 3),
+                crossed], default=False)
+            # Anything else is inconclusive or likely
+            # bad data. Set cur_cc to prev_cc
+            edited = np.where(check & ~valid,
+                prev_cc, cc)
+            if (edited == new_cc).all():
+                break
+            new_cc = edited
+        df['country_code'] = new_cc.astype(object)
         return df
-        
+
+    def get_run_starts(self, df):
+        # ids and country codes sorted by id (point order
+        # kept) and the flag of every new run of equal
+        # codes
+        ids = df.id.to_numpy()
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        cc = df.country_code.to_numpy()[order]
+        new_run = np.ones(len(ids), dtype=np.bool_)
+        new_run[1:] = (ids[1:] != ids[:-1]) | (
+            cc[1:] != cc[:-1])
+        return ids, cc, new_run
+
     def check_border_crossings(self, df):
-        bc = {}
-        for i in sorted(list(set(df.id))):
-            dfa = df.get(df.id == i)
-            num_bc = len(dfa.groupby(
-                [dfa['country_code'].ne(
-                dfa['country_code'].shift()
-                ).cumsum(), 'country_code']
-                ).size())
-            bc[i] = num_bc
-        return bc
+        """
+        Counts the runs of consecutive equal country
+        codes of every id, in point (row) order.
+        Returns a float Series indexed by sorted id.
+        """
+        ids, cc, new_run = self.get_run_starts(df)
+        # Missing codes are not a country
+        new_run &= pd.notna(cc)
+        uniq, inverse = np.unique(
+            ids, return_inverse=True)
+        return pd.Series(np.bincount(
+            inverse, weights=new_run,
+            minlength=len(uniq)), index=uniq)
+
+    def get_country_runs(self, df):
+        # id -> ((country_code, number of points), ...)
+        ids, cc, new_run = self.get_run_starts(df)
+        starts = np.flatnonzero(new_run)
+        lengths = np.diff(np.append(starts, len(ids)))
+        runs = {}
+        for i, c, n in zip(ids[starts], cc[starts],
+            lengths.tolist()):
+            runs.setdefault(i, []).append((c, n))
+        return {i: tuple(r) for i, r in runs.items()}
     
-    def country_code_to_country_name(self, cc):
-        ans = ''
-        cc_list = cc.split(',')
-        for c in cc_list:
-            if len(ans) > 0:
-                ans += ','
-            ans +=  list(self.df_country_data.get(
-                self.df_country_data.country_code \
-                == c)['country_name'])[0]
-        return ans
+    def country_code_to_country_name(self, codes):
+        # Works on a column of comma joined codes
+        return self.U.map_codes(
+            codes, self.get_country_names())
             
     def get_admin_tracking(self, df, cc):
         adm_visit = list(df.admin_name.values)
-        tot_country_adm = self.df_country_data.get(
-            self.df_country_data.country_code == cc)[[
-                'admin_name', 'admin_type']]
-        tuple_adm = list(zip(
-            tot_country_adm.admin_name,
-            tot_country_adm.admin_type))
+        rows = self.CT.find_rows('country_code', cc)
+        tot_country_adm = pd.DataFrame({
+            col: self.CT.get_column(col, rows)
+            for col in ['admin_name', 'admin_type']})
         adm_remain, visit_official =\
-            self.get_adm_areas_remain(
-            adm_visit, tuple_adm)
+            self.get_adm_areas_remain(adm_visit, cc)
         if len(tot_country_adm) == 0:
             #print(country)
             pass
@@ -334,17 +562,34 @@ class StravaData:
             http_with_code)
         self.col_names = self.config.get(
             'data', 'col_names').split(', ')
-        self.df_base = self.U.create_base(
+        self.col_set = set(self.col_names)
+        # Loaded on first use. A sync with nothing new
+        # only reads the sync state
+        self.df_base = None
+        self.AS = self.U.get_activity_store(
             self.pickles)
-        self.print_df_size_by_a_id(self.df_base)
+        self.sync_state_folder = self.config.get(
+            'path', 'sync_state_folder')
+        self.schema_version = (
+            f'{self.config.get("version", "version")}:'
+            f'{",".join(self.col_names)}')
         fname_country_data = self.config.get(
             'path',
             'fname_country_data')
         self.CD = CountryData(
             f'{self.pwd}/{fname_country_data}')
+        # One rate budget for every athlete synced,
+        # kept across runs
+        self.scheduler = RateScheduler.from_config(
+            self.config, self.pwd, 'strava')
+        if not self.code:
+            print('No code supplied. Proceeding with '
+                'local data.')
+            return
         try:
             self.headers = self.get_headers(
                 self.code)
+            self.F = self.get_fetcher(self.headers)
             print('Authorization code was '
                   'succsessful.')
         except configparser.NoSectionError:
@@ -360,43 +605,219 @@ class StravaData:
             print('No code supplied. Proceeding with '
                 'local data.')
     
+    def close(self):
+        self.CD.close()
+
     def df_by_a_id(self, df, a_id):
         return df[df['athlete/id'] == a_id]
 
+    def get_df_base(self, s_time_str='',
+        e_time_str=''):
+        if self.df_base is None:
+            self.df_base = self.U.load_activities([],
+                s_time_str=s_time_str,
+                e_time_str=e_time_str)
+            self.print_df_size_by_a_id(self.df_base)
+        return self.df_base
+
     def run(self, activity=0, page_count=200,
-        s_time_str='', e_time_str=''):
+        s_time_str='', e_time_str='', per_page=200):
         if not hasattr(self, "headers"):
-            return self.df_base
-        code_a_id = self.run_athlete_query()
-        final_time = self.get_df_final_time(
-            self.df_base, code_a_id)
-        df = self.U.setup_df()
-        if activity:
-            df, data_end = \
-                self.run_activities_query(
-                    df, code_a_id,
-                    final_time, activity=activity)
+            return self.get_df_base(
+                s_time_str, e_time_str)
+        try:
+            code_a_id = self.run_athlete_query()
+            TS = self.save_tokens(code_a_id)
+            if TS is not None:
+                # Refreshed when it expires during the
+                # download, like the batch sync
+                self.F.headers = \
+                    lambda: TS.get_headers(code_a_id)
+            self.F.cache_key = code_a_id
+            records = self.get_new_activities(self.F,
+                code_a_id, activity, page_count,
+                s_time_str, e_time_str, per_page)
+        except requests.exceptions.RequestException \
+            as e:
+            # Nothing is saved, the next sync starts
+            # from the same sync state
+            print(f'Sync failed: {e}. Proceeding with '
+                'local data.')
+            return self.get_df_base(
+                s_time_str, e_time_str)
+        if len(records) == 0:
+            print(f'{code_a_id}: '
+                'No new rides found')
         else:
-            for page in range(1, page_count):
-                df, data_end = \
-                    self.run_activities_query(
-                        df, code_a_id,
-                        final_time, activity, page=page,
-                        s_time_str=s_time_str,
-                        e_time_str=e_time_str)
-                if data_end:
-                    if len(df) == 0:
-                        print(f'{code_a_id}: '
-                            'No new rides found')
-                        return self.df_base
-                    else:
-                        break
+            self.store_activities(records, code_a_id)
+            self.df_base = None
+        return self.get_df_base(s_time_str, e_time_str)
+
+    def run_athletes(self, a_ids=None, page_count=200,
+        s_time_str='', e_time_str='', per_page=200):
+        """
+        Syncs every athlete of the token store (or
+        a_ids) at the same time under the shared rate
+        scheduler. Athletes with stored data are synced
+        first and their requests go ahead of the
+        backfills of new athletes. New activities are
+        geocoded and saved as each athlete's download
+        finishes. Returns the combined frame of all
+        stored athletes.
+        """
+        TS = self.get_token_store()
+        if TS is None:
+            return self.get_df_base(
+                s_time_str, e_time_str)
+        if a_ids is None:
+            a_ids = TS.get_athletes()
+        a_ids = sorted(a_ids, key=lambda a_id:
+            not self.AS.has_athlete(a_id))
+        print(f'Syncing {len(a_ids)} athletes')
+        workers = self.config.getint(
+            'strava', 'sync_workers')
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            futures = {pool.submit(
+                self.fetch_athlete, TS, a_id,
+                page_count, s_time_str, e_time_str,
+                per_page): a_id for a_id in a_ids}
+            for future in as_completed(futures):
+                a_id = futures[future]
+                try:
+                    records = future.result()
+                except (KeyError,
+                    requests.exceptions.RequestException
+                    ) as e:
+                    # An interrupted download is not
+                    # saved and the sync state is kept
+                    print(f'{a_id}: Sync failed: {e}')
+                    continue
+                if len(records) == 0:
+                    print(f'{a_id}: No new rides found')
+                    continue
+                self.store_activities(records, a_id)
+                self.df_base = None
+        return self.get_df_base(s_time_str, e_time_str)
+
+    def fetch_athlete(self, TS, a_id, page_count,
+        s_time_str, e_time_str, per_page):
+        # The token is read before every request. A
+        # download suspended by the rate scheduler can
+        # outlast it
+        F = self.get_fetcher(
+            lambda: TS.get_headers(a_id), a_id)
+        return self.get_new_activities(F, a_id, 0,
+            page_count, s_time_str, e_time_str,
+            per_page)
+
+    def get_new_activities(self, F, a_id, activity=0,
+        page_count=200, s_time_str='', e_time_str='',
+        per_page=200):
+        final_time, last_ids = \
+            self.get_df_final_time(a_id)
+        # A full history download waits behind the
+        # syncs of athletes with stored data
+        priority = RateScheduler.NEW if \
+            self.AS.has_athlete(a_id) else \
+            RateScheduler.BACKFILL
+        # Flattened activities, turned into one frame
+        # at the end of the sync
+        records = []
+        if activity:
+            # A requested activity is always upserted
+            self.run_activities_query(
+                records, a_id, datetime.min,
+                activity=activity, F=F)
+            return records
+        # Pages are prefetched on a thread pool and
+        # read in order
+        for page, response in F.get_pages(
+            'athlete/activities',
+            self.get_activities_params(
+            s_time_str, e_time_str),
+            per_page=per_page,
+            page_count=page_count,
+            priority=priority):
+            data_end = self.add_activities(
+                records, a_id, final_time,
+                response, page, per_page, last_ids)
+            if data_end:
+                break
+        return records
+
+    def store_activities(self, records, code_a_id):
+        df = pd.DataFrame.from_records(records,
+            columns=self.col_names)
         df = self.add_coord_columns(df)
-        df = self.clean_df(
-            self.df_base, df, code_a_id)
-        self.save_pickle(df, code_a_id)
-        self.print_df_size_by_a_id(df)
-        return df
+        new_ids = set(df.id)
+        # Only the years of the new activities and of
+        # the stored versions of their ids are read
+        # and rewritten
+        id_index = self.AS.get_id_index(code_a_id)
+        years = set(self.AS.get_years(df)) | set(
+            id_index[id_index.index.isin(df.id)])
+        df_years = self.U.load_activities([],
+            a_ids=[code_a_id], years=years)
+        df = self.clean_df(df_years, df, code_a_id)
+        df, years = self.edit_stored_borders(
+            df, new_ids, code_a_id, years)
+        self.save_activities(df, code_a_id, years)
+
+    def edit_stored_borders(self, df, new_ids, a_id,
+        years):
+        """
+        Runs edit_borders over the date-sorted stored
+        activities of the athlete, starting two
+        activities before the first new one, so new
+        activities are checked against their real
+        neighbours and edits can carry over to the
+        activities after them. Stored activities of
+        other years whose code changes are loaded and
+        saved too.
+        Args:
+            df: upserted activities of years
+            new_ids: ids of the activities just synced
+        Returns:
+            df and the years to save
+        """
+        cols = ['id', 'start_date_local',
+            'country_code', 'border_crossings']
+        df_other = self.AS.load([a_id], columns=cols)
+        if len(df_other):
+            df_other = df_other[~self.AS.get_years(
+                df_other).isin(years).to_numpy()]
+        dfa = pd.concat([df[cols], df_other],
+            ignore_index=True).sort_values(
+            by='start_date_local', kind='stable'
+            ).reset_index(drop=True)
+        new = np.flatnonzero(dfa.id.isin(new_ids))
+        if len(new) == 0:
+            return df, years
+        window = dfa.iloc[max(new[0] - 2, 0):]
+        new_cc = self.CD.edit_borders(window.copy()
+            ).country_code.reindex(window.index)
+        changed = (new_cc.fillna('') != window[
+            'country_code'].fillna('')).to_numpy()
+        if not changed.any():
+            return df, years
+        edits = dict(zip(window.id[changed],
+            new_cc[changed]))
+        print(f'{a_id}: Border crossings of '
+            f'{len(edits)} activities edited')
+        more = set(self.AS.get_years(
+            window[changed])) - set(years)
+        if more:
+            df = pd.concat([df, self.U.load_activities(
+                [], a_ids=[a_id], years=more)],
+                ignore_index=True)
+            years = set(years) | more
+        edited = df.id.isin(edits).to_numpy()
+        df.loc[edited, 'country_code'] = df.id[
+            edited].map(edits)
+        df.loc[edited, 'country_name'] = \
+            self.CD.country_code_to_country_name(
+            df.country_code[edited])
+        return df, years
     
     def get_code_from_http_string(
         self, http_with_code):
@@ -412,12 +833,34 @@ class StravaData:
         df['coords'] = df[
             'map/summary_polyline'].apply(
             polyline.decode)
-        return self.CD.get_geo(df, slice=4)
+        # The sampler is opt-in until compare_track_sampler
+        # shows no lost crossings on real tracks
+        return self.CD.get_geo(df, slice=4,
+            adaptive=self.config.getboolean(
+            'track_sampler', 'enabled', fallback=False))
         
-    def get_df_final_time(self, df, a_id,):
+    def get_sync_state(self, a_id):
+        return SyncState(self.sync_state_folder,
+            a_id, self.schema_version)
+
+    def get_df_final_time(self, a_id):
+        """
+        Returns the time of the newest stored activity
+        and the ids of the activities at that time
+        (empty when only the time is known).
+        """
+        state = self.get_sync_state(a_id)
+        if state.last_time and \
+            self.AS.has_athlete(a_id):
+            final_time = datetime.strptime(
+                state.last_time, "%Y-%m-%dT%H:%M:%SZ")
+            print(f'{a_id}: Final listed time in '
+                      f'sync state {final_time}')
+            return final_time, set(state.last_ids)
         strava_create_time = datetime.strptime(
             '2009', "%Y")
-        df = self.df_by_a_id(df, a_id)
+        df = self.AS.load([a_id],
+            columns=['start_date_local'])
         try:
             final_time = \
                 datetime.strptime(
@@ -426,13 +869,13 @@ class StravaData:
                     ascending=False).iat[0],
                     "%Y-%m-%dT%H:%M:%SZ")
             print(f'{a_id}: Final listed time in '
-                      f'pickle file {final_time}')
+                      f'activity store {final_time}')
         except:
             final_time = strava_create_time
-            print(f'{a_id}: No pickle file. Final listed '
+            print(f'{a_id}: No stored data. Final listed '
                       'time is the creation of Strava '
                       f'and is {final_time}')
-        return final_time
+        return final_time, set()
         
     def print_df_size_by_a_id(self, df):
         msg = ''
@@ -443,9 +886,11 @@ class StravaData:
         print(msg)
 
     def clean_df(self, df_base, df, code_a_id):
+        # Upsert by id, the new version of an activity
+        # replaces the stored one
         print(f'{code_a_id}: end of run_query, '
-                  'concat df\'s and remove ' 
-                  'duplicates')
+                  'upsert new activities by id')
+        df = df.drop_duplicates('id', keep='first')
         len_df = len(
             self.df_by_a_id(df, code_a_id))
         len_dfb = len(
@@ -453,8 +898,11 @@ class StravaData:
         print(f'{code_a_id}: length df: {len_df}, '
                   f'{code_a_id}: length df_base: '
                   f'{len_dfb}')
-        dfc = pd.concat([df, df_base],
-            ignore_index=True).drop_duplicates()
+        updated = pd.Index(df_base.id).isin(df.id)
+        print(f'{code_a_id}: {updated.sum()} stored '
+            'activities updated')
+        dfc = pd.concat([df, df_base[~updated]],
+            ignore_index=True)
         len_dfc = len(
             self.df_by_a_id(dfc, code_a_id))
         print(
@@ -480,6 +928,9 @@ class StravaData:
                  client_secret=\
                      STRAVA_CLIENT_SECRET,
                  code= code)
+         # Kept for the token store once the athlete
+         # id is known
+         self.access_info = access_dict
          token = access_dict.get(
              "access_token", '')
          headers = {
@@ -487,50 +938,106 @@ class StravaData:
              "Bearer {0}".format(token)}
          return headers
 
+    def get_fetcher(self, headers, a_id=None):
+        return StravaFetcher(headers,
+            base_url=self.config.get(
+            'strava', 'base_url'),
+            workers=self.config.getint(
+            'strava', 'fetch_workers'),
+            prefetch=self.config.getint(
+            'strava', 'prefetch_pages'),
+            http=HttpClient.from_config(
+            self.config, self.pwd, max_age=0,
+            retry_statuses=(500, 502, 503, 504)),
+            scheduler=self.scheduler, cache_key=a_id)
+
+    def get_token_store(self):
+        try:
+            client_id = self.secrets.get(
+                'strava', 'STRAVA_CLIENT_ID')
+            client_secret = self.secrets.get(
+                'strava', 'STRAVA_CLIENT_SECRET')
+        except configparser.NoSectionError:
+            print('Please create a secrets.ini file as '
+                  'described in the "Add Strava '
+                  'authentification strings" section of the '
+                  'README. Proceeding with local data.')
+            return None
+        fname_token_store = self.config.get(
+            'path', 'fname_token_store')
+        # Token answers must never come from the cache
+        return TokenStore(
+            f'{self.pwd}/{fname_token_store}',
+            self.config.get('strava', 'oauth_url'),
+            client_id, client_secret,
+            HttpClient.from_config(self.config,
+            self.pwd, cache_folder=''))
+
+    def save_tokens(self, a_id):
+        if hasattr(self, 'access_info') and \
+            self.access_info.get('refresh_token'):
+            TS = self.get_token_store()
+            if TS is not None:
+                TS.add(a_id, self.access_info)
+            return TS
+
     def run_athlete_query(self):
-        r = requests.get(
-            "https://www.strava.com/api/"
-            "v3/athlete",
-             headers = self.headers).json()
+        r = self.F.get('athlete')
         return r['id']
+
+    def get_activities_params(
+        self, s_time_str='', e_time_str=''):
+        params = {}
+        if s_time_str:
+            params['after'] = datetime.timestamp(
+                datetime.strptime(
+                s_time_str, '%Y-%m-%d'))
+        if e_time_str:
+            params['before'] = datetime.timestamp(
+                datetime.strptime(
+                e_time_str, '%Y-%m-%d'))
+        return params
         
     def run_activities_query(
-        self, df, a_id, final_time, activity, page=0,
-        per_page=200, s_time_str='', e_time_str=''):
-        data_end = False
+        self, records, a_id, final_time, activity, page=0,
+        per_page=200, s_time_str='', e_time_str='',
+        last_ids=set(), F=None):
+        F = F or self.F
         if activity:
-            activity_req = ('activities'
-                f'/{activity}?include_all_efforts=false')
+            response = [F.get(
+                f'activities/{activity}',
+                {'include_all_efforts': 'false'})]
         else:
-            activity_req = (
-                f'athlete/activities?page={page}&'
-                f'per_page={per_page}')
-            if s_time_str:
-                s_time_linux = datetime.timestamp(
-                    datetime.strptime(
-                    s_time_str, '%Y-%m-%d'))
-                activity_req += f'&after={s_time_linux}'
-            if e_time_str:
-                e_time_linux = datetime.timestamp(
-                    datetime.strptime(
-                    e_time_str, '%Y-%m-%d'))
-                activity_req += f'&before={e_time_linux}'
-        req = ('https://www.strava.com/api/v3/'
-            f'{activity_req}')
-        response = requests.get(req,
-            headers = self.headers,
-            timeout=180).json()
-        if 'message' in str(response):
-            print(f'Issue. Response json: {response}')
-        if activity:
-            response = [response]
+            response = F.get(
+                'athlete/activities', dict(
+                self.get_activities_params(
+                s_time_str, e_time_str),
+                page=page, per_page=per_page))
+        return self.add_activities(records, a_id,
+            final_time, response, page, per_page,
+            last_ids)
+
+    def add_activities(self, records, a_id,
+        final_time, response, page, per_page,
+        last_ids=set()):
+        data_end = False
+        if not isinstance(response, list):
+            # Raised so the activities gathered so far
+            # are not saved as a complete download
+            raise requests.exceptions.RequestException(
+                f'Unexpected response: {response}')
         for r in response:
             try:
                 code_final_time = \
                     datetime.strptime(
                     r.get('start_date_local'),
                     '%Y-%m-%dT%H:%M:%SZ')
-                if code_final_time <= final_time:
+                # Activities at final_time are new
+                # unless their id was already stored
+                if code_final_time < final_time or (
+                    code_final_time == final_time and
+                    (not last_ids or
+                    r.get('id') in last_ids)):
                     data_end = True
                     print(f'{a_id}: Data is now ' 
                               'complete. Breaking from '
@@ -538,42 +1045,36 @@ class StravaData:
                     break
             except:
                 print(f'Error, response was: {r}')
-            df_r = self.reduce_response(r)
-            df = pd.concat([df, df_r],     
-                ignore_index=True)
+            records.append(self.reduce_response(r))
         print(f'{a_id}: Page {page} has ' 
                   f'{len(response)} data points')
         if len(response) < per_page:
             print(f'{a_id}: Finished gathering data '
                       f'for page: {page}')
             data_end = True
-        return df, data_end
+        return data_end
 
     def reduce_response(self, r):
-        r.pop('start_latlng', None)
-        r.pop('end_latlng', None)
-        r.pop('available_zones', None)
-        r.pop('stats_visibility', None)
-        r.pop('segment_efforts', None)
-        r.pop('splits_metric', None)
-        r.pop('laps', None)
-        r.pop('splits_standard', None)
-        df = pd.DataFrame(
-            flatten(r, reducer='path'), index=[0])
-        df = df[[c for c in df.columns if c in \
-            self.col_names]]
-        return df
+        # Only the col_names fields of the flattened
+        # activity
+        return {k: v for k, v in flatten(
+            r, reducer='path').items()
+            if k in self.col_set}
 
-    def save_pickle(self, df, a_id):
+    def save_activities(self, df, a_id, years=()):
+        # years: partitions read for this save, the
+        # ones left without activities are removed
         df = self.df_by_a_id(df, a_id)
-        folder = self.config.get(
-            'path', 'athlete_data_folder')
-        fname = f'data_{str(a_id)}.pickle'
-        path = Path(folder)
-        if not path.exists():
-            path.mkdir(parents=True)
-        print(f'Saving as {folder}/{fname}')
-        df.to_pickle(f'{folder}/{fname}')
+        print(f'{a_id}: Saving {len(df)} activities '
+            f'to {self.AS.folder}')
+        self.AS.save(df)
+        for year in set(years) - set(
+            self.AS.get_years(df)):
+            self.AS.remove_partition(a_id, year)
+        # Only after the data is saved
+        state = self.get_sync_state(a_id)
+        state.update(df)
+        state.save()
 
 
 class Summary:
@@ -596,6 +1097,12 @@ class Summary:
         self.full_day_hrs = float(
             self.config.get('data', 'full_day_hrs'))
         self.otd_url = self.config.get('api', 'otd_url')
+        # 429 answers are left to the scheduler
+        self.http = HttpClient.from_config(
+            self.config, self.pwd,
+            retry_statuses=(500, 502, 503, 504))
+        self.otd_scheduler = RateScheduler.from_config(
+            self.config, self.pwd, 'otd')
         self.pwd = Path.cwd()
         self.units = units = self.config.get(
             'units', 'dist_label')
@@ -608,7 +1115,14 @@ class Summary:
         elevations=False,
         parts_replacement=False):
          print('×××××× Summary by Athlete ××××××')
-         df = self.U.create_base(self.pickles)
+         if parts_replacement:
+             # Parts are summarized over their own
+             # time ranges
+             df = self.U.load_activities(self.pickles)
+         else:
+             df = self.U.load_activities(self.pickles,
+                 s_time_str=s_time_str,
+                 e_time_str=e_time_str)
          print(f'Start Time: {s_time_str}')
          print(f'End Time: {e_time_str}')
          if activity:
@@ -795,15 +1309,15 @@ class Summary:
             idx],) for idx, x in enumerate(lst)]
         return lst
     
-    def get_elevations(self, lst, req_limit=100):
+    def get_elevations(self, lst, req_limit=100,
+        max_retries=3):
         elevations = []
         wait_time =round(len(lst)/req_limit + 0.49)
         print('Adding elevation data to gpx. '
-            f'Limited to {req_limit} requests per '
-            f'second. There are {len(lst)} requests. ' 
+            f'Limited to {req_limit} locations per '
+            f'request. There are {len(lst)} locations. ' 
             f'Please wait for {wait_time} requests.')
         for i in range(0, len(lst), req_limit):
-            time.sleep(0.8)
             coords = pd.DataFrame(
                 lst[i: i + req_limit],
                 columns=['lat', 'long'])
@@ -813,8 +1327,8 @@ class Summary:
                 coords_str.replace('\n', '|').split())
             req_data = {"locations": coords_str,
                                  "interpolation": "bilinear"}
-            r = requests.post(
-                self.otd_url, data=req_data, timeout=10)
+            r = self.post_elevations(req_data,
+                max_retries)
             if r.json()['status'] == 'OK':
                 results = r.json()['results']
                 elevations += [
@@ -824,9 +1338,30 @@ class Summary:
                 e = r.json()['error']
                 print(f'Error in add_elevation: {e}. '
                     'Adding "0"s instead')
-                elevations += len(i) * [0]
+                elevations += len(coords) * [0]
         return elevations
 
+    def post_elevations(self, req_data, max_retries):
+        # Paced by the OpenTopoData budget (requests
+        # per second and per day), a 429 is waited out
+        # and retried
+        for retry in range(max_retries + 1):
+            self.otd_scheduler.acquire()
+            headers = None
+            try:
+                r = self.http.post(self.otd_url,
+                    data=req_data, timeout=10)
+                headers = r.headers
+            finally:
+                self.otd_scheduler.release(headers,
+                    limited=headers is not None and \
+                    r.status_code == 429)
+            if r.status_code != 429:
+                break
+            print('OpenTopoData rate limit hit (429). '
+                f'Retry {retry + 1}')
+        return r
+
     def save_gpx(self, df, elevations, fname='out',
         sort= False):
         print(f'Saving gpx file as: {fname}')
@@ -922,8 +1457,10 @@ class Map:
             'units', 'sec_to_hr'))
         self.emoji = self.config._sections[
             'map_emoji']
-        self.country_flag = self.config._sections[
-            'country_flag']
+        self.country_flag = {
+            k.upper(): v for k, v in
+            self.config._sections['country_flag'
+            ].items()}
         fname_country_data = self.config.get(
             'path', 'fname_country_data')
         self.CD = CountryData(
@@ -931,13 +1468,25 @@ class Map:
         self.U = Utils()
         self.pickles = self.U.get_local_pickle_files()
 
-    def run(self, http_with_code,
-        s_time_str='', e_time_str='', activity=0):
+    def run(self, http_with_code='',
+        s_time_str='', e_time_str='', activity=0,
+        all_athletes=False):
+        # all_athletes: sync every athlete of the token
+        # store instead of the one of http_with_code
         S = StravaData(self.pickles, http_with_code)
-        df = S.run(
-            s_time_str=s_time_str,
-            e_time_str=e_time_str,
-            activity=activity).dropna(
+        try:
+            if all_athletes:
+                df = S.run_athletes(
+                    s_time_str=s_time_str,
+                    e_time_str=e_time_str)
+            else:
+                df = S.run(
+                    s_time_str=s_time_str,
+                    e_time_str=e_time_str,
+                    activity=activity)
+        finally:
+            S.close()
+        df = df.dropna(
             subset=['map/summary_polyline'])
         df = self.U.limit_time(
              s_time_str, df, start=True)
@@ -962,6 +1511,10 @@ class Map:
             autoZIndex=True))
 
     def create_country_summaries(self, df):
+         # Categorical codes so get_popup only splits
+         # each distinct code string once
+         df = df.assign(country_code=
+             df.country_code.astype('category'))
          df_cc = self.CD.get_country_centroids()
          for _, row in df_cc.iterrows():
              cc = row['country_code']
@@ -989,6 +1542,7 @@ class Map:
                         "padding: 3px;"
                         "min_width: 6000")))
              self.m.add_child(mk)
+         self.CD.save_admin_matches()
 
     def get_top_words(self, df):
          text = ' '.join(df['name'])
@@ -1012,8 +1566,8 @@ class Map:
             'Administrative Areas Visited':[],
             'Administrative Areas Remain':[],
             'Top Words!':[]}
-        dfc = df[df.country_code.apply(
-            str).str.contains(cc)]
+        dfc = df[self.U.has_code(
+            df.country_code, cc)]
         if len(dfc) == 0:
             return ''
         for a_id in self.athlete_ids_list:
@@ -1084,12 +1638,10 @@ class Map:
         else:
             return self.emoji['other']
     
-    def get_country_flag(self, cc):
-         emojis = ''
-         for c in cc.lower().split(','):
-             if c.strip() in self.country_flag:
-                 emojis += self.country_flag[c.strip()]
-         return emojis
+    def get_country_flag(self, codes):
+         # Works on a column of comma joined codes
+         return self.U.map_codes(codes,
+             self.country_flag, sep='')
      
     def get_link(self, id):
         url = ('https://www.strava.com'
@@ -1110,8 +1662,8 @@ class Map:
 
     def create_lines(self, df, a_ids):
         df['emoji'] = df['type'].apply(self.get_emoji) +\
-            df['country_code'].apply(
-            self.get_country_flag) + ' (' +\
+            self.get_country_flag(
+            df['country_code']) + ' (' +\
             df['admin_name'] + ')'
         df['link'] = df['id'].apply(self.get_link)
         df['distance'] = round(df['distance'] * \
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3.11
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+
+class TokenStore:
+    """
+    Strava tokens of every athlete synced so far, kept
+    in a local json file as {athlete id: {access_token,
+    refresh_token, expires_at}}. Access tokens that
+    expire within margin seconds are refreshed with the
+    refresh token, and the file is replaced atomically
+    after every change.
+    """
+    def __init__(self, fname, oauth_url, client_id,
+        client_secret, http, margin=300):
+        self.fname = fname
+        self.oauth_url = oauth_url.rstrip('/')
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.http = http
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.load()
+
+    def get_athletes(self):
+        return sorted(int(a_id) for a_id in self.tokens)
+
+    def add(self, a_id, access_info):
+        with self.lock:
+            self.tokens[str(a_id)] = {
+                'access_token':
+                    access_info['access_token'],
+                'refresh_token':
+                    access_info['refresh_token'],
+                'expires_at':
+                    int(access_info['expires_at'])}
+            self.save()
+
+    def get_headers(self, a_id):
+        with self.lock:
+            tokens = self.tokens[str(a_id)]
+            if tokens['expires_at'] - self.margin < \
+                time.time():
+                tokens = self.refresh(a_id, tokens)
+        return {'Authorization':
+            f'Bearer {tokens["access_token"]}'}
+
+    def refresh(self, a_id, tokens):
+        print(f'{a_id}: Refreshing Strava access token')
+        r = self.http.post(f'{self.oauth_url}/token',
+            data={'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'refresh_token',
+            'refresh_token': tokens['refresh_token']},
+            timeout=60)
+        r.raise_for_status()
+        j = r.json()
+        tokens = {'access_token': j['access_token'],
+            'refresh_token': j['refresh_token'],
+            'expires_at': int(j['expires_at'])}
+        self.tokens[str(a_id)] = tokens
+        self.save()
+        return tokens
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                self.tokens = json.load(f)
+        except (FileNotFoundError,
+            json.JSONDecodeError):
+            self.tokens = {}
+
+    def save(self):
+        Path(self.fname).parent.mkdir(
+            parents=True, exist_ok=True)
+        tmp = f'{self.fname}.tmp'
+        # Owner only, the file holds credentials
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT |
+            os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.tokens, f, indent=1)
+        os.replace(tmp, self.fname)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.11
+import numpy as np
+
+
+class TrackSampler:
+    """
+    Picks the track points worth geocoding. Every point
+    within near_deg of a boundary edge is kept once it
+    is min_step_deg past the last one. Further inside a
+    country the step grows with the distance to the
+    closest boundary edge (step_ratio * distance) up
+    to max_step_deg. Distances are to the edges, not
+    the vertices, which are sparse along straight
+    borders. The first and last point of every
+    activity are always kept.
+    Boundary distances are only looked up for probe
+    points every near_deg / 2 along the track. In
+    between, the distance can only shrink by the
+    distance travelled, which gives a lower bound for
+    every other point.
+    version is part of the activity geo cache key and
+    changes with the way points are picked.
+    """
+    version = 2
+
+    def __init__(self, boundary_index, min_step_deg=0.001,
+        max_step_deg=0.05, near_deg=0.05, step_ratio=0.25):
+        self.BI = boundary_index
+        self.min_step_deg = min_step_deg
+        self.max_step_deg = max_step_deg
+        self.near_deg = near_deg
+        self.step_ratio = step_ratio
+
+    def run(self, ids, lat, lon):
+        """
+        Args:
+            ids, lat, lon (arrays): points of one or
+            more activities, in track order and grouped
+            by id
+        Returns:
+            keep (bool array): one flag per point
+        """
+        ids = np.asarray(ids)
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        if len(ids) == 0:
+            return np.zeros(0, dtype=np.bool_)
+        ends = self.get_ends(ids)
+        travelled = np.cumsum(
+            self.get_segments(ids, lat, lon))
+        probes = np.flatnonzero(self.get_steps(
+            travelled, self.near_deg / 2) | ends)
+        dist = self.BI.get_edge_distance(
+            lat[probes], lon[probes])
+        dist = self.get_lower_bound(
+            len(ids), probes, dist, travelled)
+        step = np.where(dist < self.near_deg,
+            self.min_step_deg, np.clip(
+            dist * self.step_ratio, self.min_step_deg,
+            self.max_step_deg))
+        travelled = np.cumsum(
+            self.get_segments(ids, lat, lon) / step)
+        return self.get_steps(travelled, 1) | ends
+
+    def get_ends(self, ids):
+        # First and last point of every activity
+        new_id = np.ones(len(ids) + 1, dtype=np.bool_)
+        new_id[1:-1] = ids[1:] != ids[:-1]
+        return new_id[:-1] | new_id[1:]
+
+    def get_segments(self, ids, lat, lon):
+        # Distance from the previous point of the same
+        # activity
+        seg = np.hypot(np.diff(lat, prepend=lat[0]),
+            np.diff(lon, prepend=lon[0]))
+        seg[1:][ids[1:] != ids[:-1]] = 0
+        return seg
+
+    def get_steps(self, travelled, step):
+        # Flags the points where travelled passes a
+        # whole step
+        passed = np.floor(travelled / step)
+        flags = np.ones(len(passed), dtype=np.bool_)
+        flags[1:] = passed[1:] != passed[:-1]
+        return flags
+
+    def get_lower_bound(self, num, probes, dist,
+        travelled):
+        # Boundary distance of every point from the
+        # probes before and after it. Activity ends are
+        # probes so both are in the same activity
+        is_probe = np.zeros(num, dtype=np.bool_)
+        is_probe[probes] = True
+        prev = np.cumsum(is_probe) - 1
+        nxt = np.where(is_probe, prev, prev + 1)
+        return np.maximum(
+            dist[prev] - (travelled - travelled[
+                probes[prev]]),
+            dist[nxt] - (travelled[probes[nxt]] -
+                travelled))
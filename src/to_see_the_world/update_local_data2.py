@@ -4,12 +4,13 @@ from time import time
 
 import pandas as pd
 from pathlib import Path
-import requests
 from io import BytesIO
 from zipfile import ZipFile
-from urllib.request import urlopen
 from scipy.spatial import KDTree
 
+from compiled_data import CityTable, CountryTable
+from geo_index import BoundaryIndex, InteriorGrid
+from http_client import HttpClient
 from supporting_data.country_boundaries_shifted import ShiftBoundaries
 
     
@@ -32,6 +33,8 @@ class Datasets():
         self.url_cities500 = \
             self.config.get('url', 'url_cities500')
         self.SB = ShiftBoundaries()
+        self.http = HttpClient.from_config(
+            self.config, self.pwd)
      
     def run(self, force=False):
         # files:
@@ -43,6 +46,7 @@ class Datasets():
             self.run_country_boundaries(shift=False)
             self.run_country_data()
             self.run_cities500()
+            self.run_compiled_data(rebuild=True)
             return
         if not Path(f'{self.pwd}/'
             f'{self.fname_shifted_boundaries}'
@@ -56,6 +60,7 @@ class Datasets():
             f'{self.fname_cities500}'
             ).is_file():
             self.run_cities500()
+        self.run_compiled_data()
         print('Files all exists. Please check the '
            'supporting_data folder for: '
             'country_boundaries.csv, '
@@ -86,6 +91,28 @@ class Datasets():
         self.save_shifted_boundaries(
             df[['lat', 'lon', 'country_code', 'fid']])
    
+    def run_compiled_data(self, rebuild=False):
+        # Compiled next to each csv and only rebuilt
+        # when the csv content changes
+        for compiled, fname in [
+            (BoundaryIndex, self.fname_shifted_boundaries),
+            (CityTable, self.fname_cities500),
+            (CountryTable, self.fname_country_data)]:
+            if Path(f'{self.pwd}/{fname}').is_file():
+                compiled(f'{self.pwd}/{fname}',
+                    rebuild=rebuild)
+        self.run_interior_grid(rebuild=rebuild)
+
+    def run_interior_grid(self, rebuild=False):
+        fname = (f'{self.pwd}/'
+            f'{self.fname_shifted_boundaries}')
+        if Path(fname).is_file():
+            InteriorGrid(fname,
+                cell_deg=self.config.getfloat(
+                'interior_grid', 'cell_deg',
+                fallback=0.1),
+                rebuild=rebuild)
+   
     def calculate_flat_dict(self,
         country_polygons_sub,
         flat_dict, shift):
@@ -215,7 +242,7 @@ class Datasets():
             'query?where=1%3D1&outFields=*'
             '&returnGeometry=false&returnCountOnly'
             '=true&outSR=4326&f=json')
-        c = requests.get(url, timeout = 30).json()
+        c = self.http.get(url, timeout = 30).json()
         return c['count']
     
     def get_country_data(self):
@@ -243,16 +270,10 @@ class Datasets():
                 f'&resultOffset={result_offset}'
                 '&resultRecordCount='
                 f'{result_record_count}')
-            for retry in range(0,4):
-                j = requests.get(f'{url}{url_offset}',
-                    timeout = 60)
-                if j.ok:
-                    j = j.json()
-                    break
-                else:
-                    print('Trying get_country_data again ' 
-                        f'({retry}/5). '
-                        f'Status code: {j.status_code}')
+            r = self.http.get(f'{url}{url_offset}',
+                timeout = 60)
+            r.raise_for_status()
+            j = r.json()
             for feature in j['features']:
                 att = feature['attributes']
                 admin_name = att['NAME']
@@ -318,15 +339,9 @@ class Datasets():
             f"ISO_CC%20%3D%20'{val}'&"
             "outFields=COUNTRY,CONTINENT"
             ",LAND_RANK,FID&outSR=4326&f=json")
-        for retry in range(0,4):
-            j = requests.get(url, timeout = 60)
-            if j.ok:
-                j = j.json()
-                break
-            else:
-                print('Trying get_country_data again ' 
-                    f'({retry}/5). '
-                    f'Status code: {j.status_code}')
+        r = self.http.get(url, timeout = 60)
+        r.raise_for_status()
+        j = r.json()
         for feature in j['features']:
             #if feature['attributes']['LAND_RANK'] <= 2:
             #    continue
@@ -358,8 +373,10 @@ class Datasets():
     
     def run_cities500(self):
         print('Updating cities500.csv')
-        resp = urlopen(f'{self.url_cities500}')
-        zipfile = ZipFile(BytesIO(resp.read()))
+        resp = self.http.get(self.url_cities500,
+            timeout = 300)
+        resp.raise_for_status()
+        zipfile = ZipFile(BytesIO(resp.content))
         fname = zipfile.namelist()[0]
         col_names = ['geonameid','name','asciiname','alternatenames','lat','lon','feature class','feature code','cc','cc2','admin1','admin2','admin3','admin4','population','elevation','dem','timezone','modification date']#['geonameid','lat','lon','name','admin1','admin2','cc']
         df = pd.read_csv(